@@ -1,14 +1,35 @@
 import logging
-import os
+import math
 import secrets
-import datetime
-import uuid
-
-from flask import Flask, jsonify, render_template, request, redirect, url_for
-
-from utilities.orm.methods import load_rows_to_database, query, fetch_report
-from utilities.orm.models import BatchAnalysis, CanvassResult
-from utilities.llm.methods import assemble_prompt, query_gpt
+import time
+import json
+
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    render_template,
+    request,
+    redirect,
+    url_for,
+)
+from markupsafe import escape
+
+from utilities.geo import WORLD, BoundingBox, is_cell
+from utilities.orm.ingest import (
+    RecordError,
+    canvass_result_values,
+    export_canvass_results,
+    get_memo_buffer,
+    ingest_canvass_results,
+    iter_json_records,
+    memo_buffer_stats,
+)
+from utilities.llm.cache import get_response_cache
+from utilities.orm.methods import get_pool_metrics
+from utilities.orm.partitions import purge_canvass_results
+from utilities import metrics, reports
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +43,63 @@ app = Flask(
 # Fine to set this once at import time
 app.secret_key = secrets.token_urlsafe(16)
 
+metrics.register_collector(
+    "db_pool",
+    get_pool_metrics,
+    counters=("checkouts", "waits", "wait_seconds_total", "timeouts"),
+)
+metrics.register_collector(
+    "llm_cache",
+    lambda: get_response_cache().stats() if get_response_cache() else {},
+    counters=("hits", "misses", "stores", "evictions"),
+)
+metrics.register_collector(
+    "memo_buffer",
+    memo_buffer_stats,
+    counters=("flushed_rows", "flushed_batches", "failed_rows"),
+)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+    if metrics.request_log_enabled():
+        metrics.start_request_spans()
+
+
+@app.after_request
+def record_request_timing(response):
+    started_at = g.pop("request_started_at", None)
+    if started_at is None:
+        return response
+    seconds = time.perf_counter() - started_at
+    # Route patterns rather than paths, so labels stay few
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    spans = metrics.finish_request_spans() if metrics.request_log_enabled() else {}
+    metrics.observe(
+        "http_request_duration_seconds",
+        seconds,
+        route=route,
+        method=request.method,
+        status=str(response.status_code),
+    )
+    if metrics.request_log_enabled():
+        logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "route": route,
+                    "status": response.status_code,
+                    "duration_ms": round(seconds * 1000, 3),
+                    "spans_ms": {
+                        name: round(span * 1000, 3) for name, span in spans.items()
+                    },
+                }
+            )
+        )
+    return response
+
 
 @app.route("/")
 def index():
@@ -30,32 +108,47 @@ def index():
 
 @app.route("/api/receive_memo", methods=["POST"])
 def receive_memo():
-    response = request.get_json()
-    data = jsonify(response)
-    canvass_result = CanvassResult(
-        geo_lat=data["geo_lat"],
-        geo_long=data["geo_long"],
-        memo=data["memo"],
-        created_at=datetime.datetime.now(),
-        canvass_result_id=str(uuid.uuid4()),
-    )
-    load_rows_to_database(canvass_result)
-    return 200
+    try:
+        values = canvass_result_values(request.get_json())
+    except RecordError as error:
+        return jsonify(error=str(error)), 400
+    # Committed together with other concurrent memos, see utilities.orm.ingest
+    memo_buffer = get_memo_buffer()
+    memo_buffer.submit(values)
+    status = 201 if memo_buffer.ack_after_flush else 202
+    return jsonify(canvass_result_id=values["canvass_result_id"]), status
+
+
+@app.route("/api/receive_memos", methods=["POST"])
+def receive_memos():
+    # Bulk sync of queued memos, as a JSON array or NDJSON with one memo per line
+    summary = ingest_canvass_results(iter_json_records(request.stream))
+    return jsonify(summary)
+
+
+@app.route("/api/export_memos")
+def export_memos():
+    return Response(export_canvass_results(), mimetype="application/x-ndjson")
 
 
 @app.route("/generate_report")
 def generate_report():
-    query_response = query("select memo from canvassresult")
-    all_memos: list[str] = [row[0] for row in query_response]
-    gpt_prompt = assemble_prompt(all_memos)
-    gpt_output = query_gpt(gpt_prompt)
-    batch_analysis = BatchAnalysis(
-        batch_analysis_id=str(uuid.uuid4()),
-        gpt_input_prompt=gpt_prompt,
-        gpt_output=gpt_output,
-        created_at=datetime.datetime.now(),
+    # Incremental by default, ?full=1 re-summarizes every memo and ?days=N reports
+    # on only the memos of the last N days
+    days = request.args.get("days")
+    if days is not None:
+        if not days.isdigit() or int(days) < 1:
+            return jsonify(error="days must be a positive integer."), 400
+        days = int(days)
+    batch_analysis = reports.generate_report(
+        full=request.args.get("full") == "1", days=days
+    )
+    return jsonify(
+        batch_analysis_id=batch_analysis.batch_analysis_id,
+        memo_count=batch_analysis.memo_count,
+        sampled_memo_count=batch_analysis.sampled_memo_count,
+        sampled_token_count=batch_analysis.sampled_token_count,
     )
-    load_rows_to_database(batch_analysis)
 
 
 @app.route("/report")
@@ -65,13 +158,85 @@ def report():
 
 @app.route("/get_report")
 def get_report():
-    generate_report()
-    result = fetch_report()
-    result = result.replace("\n", "<br>")
-    return result
+    # Served from cache, regenerated in the background when memos change. The job
+    # doing that is passed on so the page can follow it.
+    result, report_job_id = reports.get_cached_report()
+    response = Response(str(escape(result)).replace("\n", "<br>"))
+    if report_job_id is not None:
+        response.headers["X-Report-Job-Id"] = report_job_id
+    return response
+
+
+@app.route("/api/report_jobs", methods=["POST"])
+def start_report_job():
+    # Starts a report job, or attaches to the one already running
+    report_job_id = reports.start_report_job(full=request.args.get("full") == "1")
+    return jsonify(report_job_id=report_job_id), 202
+
+
+@app.route("/api/report_jobs/<report_job_id>")
+def report_job_status(report_job_id):
+    status = reports.report_job_status(report_job_id)
+    if status is None:
+        return jsonify(error="No such report job."), 404
+    return jsonify(status)
+
+
+@app.route("/api/report_jobs/<report_job_id>/stream")
+def stream_report_job(report_job_id):
+    # Server-sent events with the report text as it is generated
+    def events():
+        for event, data in reports.stream_report_job(report_job_id):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/region_report")
+def region_report():
+    # ?cell=<geohash> or ?bbox=<south>,<west>,<north>,<east>
+    cell = request.args.get("cell")
+    bbox = request.args.get("bbox")
+    if cell is not None and bbox is None:
+        if not is_cell(cell):
+            return jsonify(error="Invalid geohash cell."), 400
+        return jsonify(reports.generate_region_report(cell=cell))
+    if bbox is not None and cell is None:
+        try:
+            box = BoundingBox(*(float(value) for value in bbox.split(",")))
+        except (TypeError, ValueError):
+            return jsonify(error="Invalid bounding box."), 400
+        if not all(math.isfinite(value) for value in box):
+            return jsonify(error="Invalid bounding box."), 400
+        box = box.intersection(WORLD)
+        if box.south > box.north or box.west > box.east:
+            return jsonify(error="Invalid bounding box."), 400
+        return jsonify(reports.generate_region_report(box=box))
+    return jsonify(error="Pass either cell or bbox."), 400
+
+
+@app.route("/api/topic_counts")
+def topic_counts():
+    # Local topic clusters, no GPT call involved. Imported here to keep numpy out of
+    # worker startup.
+    from utilities.llm.clustering import refresh_topic_model
+
+    model = refresh_topic_model()
+    return jsonify(memo_count=model.document_count, topics=model.topics())
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/purge")
 def purge():
-    query("delete from canvassresult where true")
+    # Drops the per-day partitions rather than deleting row by row, so memos keep
+    # coming in meanwhile
+    purge_canvass_results()
     return redirect(url_for("index"))
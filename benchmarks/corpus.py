@@ -0,0 +1,81 @@
+"""Synthetic canvass result corpora built from the seed memos.
+
+Memos are recombined from the sentences of utilities.orm.seeds.memos with streets
+swapped, so a corpus has realistic memo lengths and vocabulary, plenty of
+near-duplicates, and enough variety that deduplication and clustering do not
+collapse it to the 40 seeds. Coordinates are spread over a few Clarksdale
+neighborhoods and timestamps over the two weeks before the day of the run (memos too
+old are refused at ingest), so every run with the same seed builds the same memos.
+"""
+
+import datetime
+import random
+import re
+from typing import Iterator
+
+from utilities.orm import seeds
+
+STREETS = [
+    "Cherry Street",
+    "Harrison Avenue",
+    "School Street",
+    "Walnut Street",
+    "Mills Avenue",
+    "Issaquena Avenue",
+    "Sunflower Avenue",
+    "Desoto Avenue",
+    "Yazoo Avenue",
+    "Oakhurst Avenue",
+]
+
+# Centers of canvassed neighborhoods around Clarksdale, Mississippi
+NEIGHBORHOODS = [
+    (34.2001, -90.5709),
+    (34.1935, -90.5802),
+    (34.2087, -90.5631),
+    (34.1862, -90.5655),
+    (34.2150, -90.5820),
+    (34.1990, -90.5480),
+]
+
+DAYS = 14
+
+_SENTENCE = re.compile(r"[^.!?]+[.!?]*")
+_STREET = re.compile(r"\b[A-Z][a-z]+ (?:Street|street|Avenue)\b")
+
+
+def seed_sentences() -> list[list[str]]:
+    """The sentences of each seed memo."""
+    return [
+        [sentence.strip() for sentence in _SENTENCE.findall(memo) if sentence.strip()]
+        for memo in seeds.memos
+    ]
+
+
+def synthetic_memo(rng: random.Random, sentences: list[list[str]]) -> str:
+    """One memo: a run of sentences from a seed, with a few from another mixed in."""
+    base = rng.choice(sentences)
+    start = rng.randrange(len(base))
+    picked = base[start : start + rng.randint(2, 6)]
+    other = rng.choice(sentences)
+    picked.insert(rng.randint(0, len(picked)), rng.choice(other))
+    memo = " ".join(picked)
+    return _STREET.sub(lambda _: rng.choice(STREETS), memo)
+
+
+def generate_records(rows: int, seed: int = 0) -> Iterator[dict]:
+    """rows memo records in the format accepted by /api/receive_memos."""
+    rng = random.Random(seed)
+    sentences = seed_sentences()
+    end_date = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    for _ in range(rows):
+        latitude, longitude = rng.choice(NEIGHBORHOODS)
+        created_at = end_date - datetime.timedelta(
+            seconds=rng.uniform(0, DAYS * 24 * 3600)
+        )
+        yield {
+            "geo_lat": round(latitude + rng.gauss(0, 0.003), 6),
+            "geo_long": round(longitude + rng.gauss(0, 0.003), 6),
+            "memo": synthetic_memo(rng, sentences),
+            "created_at": created_at.isoformat(),
+        }
@@ -0,0 +1,189 @@
+#!/bin/python3
+
+"""Benchmark memo ingestion and reporting against synthetic corpora.
+
+For each corpus size a fresh SQLite database is loaded with synthetic memos (see
+benchmarks.corpus), the first report is generated, and then generated or recorded
+traffic (see benchmarks.traffic) is replayed concurrently against the Flask app.
+GPT is replaced by the deterministic stub backend with LLM_STUB_LATENCY_MS latency,
+and the response cache is off so every call pays that latency.
+
+Each size runs in its own process, so engines, buffers and caches start cold.
+
+Results are written as JSON and can be compared with an earlier run:
+
+```
+PYTHONPATH=. python3 benchmarks/run.py --sizes 1000 10000 --output baseline.json
+PYTHONPATH=. python3 benchmarks/run.py --sizes 1000 10000 --compare baseline.json
+```
+
+--compare exits with status 1 if any operation's p50, p95 or p99 latency or the
+report time rose, or the ingest or overall replay throughput fell, by more than
+--tolerance.
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+
+def run_size(rows: int, args: argparse.Namespace) -> dict:
+    """Benchmark one corpus size. Runs in a fresh process with the environment set."""
+    from application.main import app
+    from benchmarks.corpus import generate_records
+    from benchmarks.traffic import generate_traffic, read_traffic, replay, summarize
+    from utilities import reports
+    from utilities.orm.ingest import close_memo_buffer, ingest_canvass_results
+    from utilities.orm.methods import create_new_tables
+
+    create_new_tables()
+    results = {}
+
+    start = time.perf_counter()
+    summary = ingest_canvass_results(generate_records(rows, seed=args.seed))
+    seconds = time.perf_counter() - start
+    results["bulk_ingest"] = {
+        "count": summary["inserted"],
+        "failures": summary["failed"],
+        "throughput_per_second": round(summary["inserted"] / seconds, 2),
+    }
+
+    start = time.perf_counter()
+    reports.generate_report(full=True)
+    results["generate_report_full"] = {
+        "count": 1,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+    if args.traffic:
+        with open(args.traffic) as stream:
+            traffic = read_traffic(stream)
+    else:
+        traffic = generate_traffic(args.requests, seed=args.seed)
+    outcome, wall_seconds = replay(app, traffic, args.concurrency)
+    close_memo_buffer()
+    for operation, latencies in sorted(outcome["latencies"].items()):
+        results[operation] = summarize(latencies, outcome["failures"].get(operation, 0))
+    results["replay"] = {
+        "count": len(traffic),
+        "throughput_per_second": round(len(traffic) / wall_seconds, 2),
+    }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions of results against baseline, as readable lines."""
+    regressions = []
+    for size, operations in results["sizes"].items():
+        for operation, current in operations.items():
+            previous = baseline.get("sizes", {}).get(size, {}).get(operation)
+            if previous is None:
+                continue
+            # Only bulk_ingest and replay record a throughput; baselines from before
+            # may still have one per replayed operation, which is not comparable
+            for key, higher_is_worse in (
+                ("p50_ms", True),
+                ("p95_ms", True),
+                ("p99_ms", True),
+                ("seconds", True),
+                ("throughput_per_second", False),
+            ):
+                if key not in current or key not in previous or not previous[key]:
+                    continue
+                change = current[key] / previous[key] - 1
+                print(
+                    f"{size:>7} {operation:<22} {key:<22} {previous[key]:>12} -> {current[key]:>12} ({change:+.1%})"
+                )
+                if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                    regressions.append(
+                        f"{operation} {key} at {size} rows: {previous[key]} -> {current[key]}"
+                    )
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--requests", type=int, default=2000, help="generated requests per size")
+    parser.add_argument("--traffic", help="JSONL traffic file to replay instead")
+    parser.add_argument("--save-traffic", help="write generated traffic here and exit")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.save_traffic:
+        from benchmarks.traffic import generate_traffic, write_traffic
+
+        with open(args.save_traffic, "w") as stream:
+            write_traffic(generate_traffic(args.requests, seed=args.seed), stream)
+        return 0
+
+    results = {
+        "meta": {
+            "created_at": datetime.datetime.now().isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "settings": {
+                key: value for key, value in vars(args).items()
+                if key not in ("output", "compare", "save_traffic")
+            },
+        },
+        "sizes": {},
+    }
+
+    spawn = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.sizes:
+            # Children are spawned, so they read this environment at import
+            os.environ.update(
+                DATABASE_URL=f"sqlite:///{directory}/benchmark_{rows}.db",
+                LLM_BACKEND="stub",
+                LLM_STUB_LATENCY_MS=str(args.llm_latency_ms),
+                LLM_CACHE="0",
+            )
+            print(f"Benchmarking {rows} rows...", file=sys.stderr)
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                results["sizes"][str(rows)] = executor.submit(run_size, rows, args).result()
+
+    print(json.dumps(results["sizes"], indent=2))
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2)
+            stream.write("\n")
+
+    if args.compare:
+        with open(args.compare) as stream:
+            baseline = json.load(stream)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
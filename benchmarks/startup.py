@@ -0,0 +1,103 @@
+#!/bin/python3
+
+"""Benchmark worker startup: importing the app and serving the first memo.
+
+Each measurement runs in a fresh interpreter, timed from before the first import:
+    import_seconds: importing application.main
+    modules_imported: modules loaded once it is imported
+    first_receive_memo_seconds: importing it and serving one /api/receive_memo
+    llm_stack_seconds: additionally importing the LLM stack, which workers defer
+        until their first report
+
+```
+PYTHONPATH=. python3 benchmarks/startup.py --runs 5 --output startup.json
+```
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Runs in the child interpreter, with the measurements to take as arguments
+_CHILD = """
+import time
+start = time.perf_counter()
+import application.main
+imported = time.perf_counter()
+
+import json
+import sys
+result = {"import_seconds": imported - start, "modules_imported": len(sys.modules)}
+if "first_request" in sys.argv:
+    from utilities.orm.methods import create_new_tables
+    create_new_tables()
+    start_request = time.perf_counter()
+    response = application.main.app.test_client().post(
+        "/api/receive_memo",
+        json={"geo_lat": 34.2, "geo_long": -90.57, "memo": "Benchmark memo."},
+    )
+    assert response.status_code < 400, response.status_code
+    # Table creation is a deployment step, not part of serving
+    result["first_receive_memo_seconds"] = (
+        imported - start + time.perf_counter() - start_request
+    )
+if "llm_stack" in sys.argv:
+    from utilities.llm.methods import preload
+    start_llm = time.perf_counter()
+    preload()
+    result["llm_stack_seconds"] = time.perf_counter() - start_llm
+print(json.dumps(result))
+"""
+
+
+def measure(database_url: str, *measurements: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD, *measurements],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={**os.environ, "DATABASE_URL": database_url, "PYTHONPATH": "."},
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    samples: dict[str, list[float]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for run in range(args.runs):
+            database_url = f"sqlite:///{directory}/startup_{run}.db"
+            for result in (
+                measure(database_url),
+                measure(database_url, "first_request"),
+                measure(database_url, "llm_stack"),
+            ):
+                for key, value in result.items():
+                    samples.setdefault(key, []).append(value)
+
+    results = {
+        key: {
+            "median": round(statistics.median(values), 4),
+            "min": round(min(values), 4),
+            "max": round(max(values), 4),
+        }
+        for key, values in samples.items()
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(results, stream, indent=2)
+            stream.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Generating and replaying request traffic against the Flask app.
+
+Traffic is JSONL, one request per line, so recorded traffic can be replayed as well
+as generated traffic:
+
+```
+{"method": "POST", "path": "/api/receive_memo", "json": {"geo_lat": 34.2, "geo_long": -90.57, "memo": "..."}}
+{"method": "GET", "path": "/get_report"}
+{"call": "fetch_report"}
+```
+
+Lines with "call" run a function in-process instead of a request, for code paths
+that have no route of their own.
+"""
+
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Iterable
+
+from benchmarks.corpus import NEIGHBORHOODS, seed_sentences, synthetic_memo
+from utilities.orm.methods import fetch_report
+
+CALLS: dict[str, Callable[[], object]] = {"fetch_report": fetch_report}
+
+# Share of each kind of request in generated traffic, mostly memo uploads
+DEFAULT_MIX = {"receive_memo": 0.90, "get_report": 0.08, "fetch_report": 0.02}
+
+
+def generate_traffic(
+    requests: int, mix: dict[str, float] = DEFAULT_MIX, seed: int = 0
+) -> list[dict]:
+    rng = random.Random(seed)
+    sentences = seed_sentences()
+    kinds, weights = zip(*mix.items())
+    traffic = []
+    for kind in rng.choices(kinds, weights, k=requests):
+        if kind == "receive_memo":
+            latitude, longitude = rng.choice(NEIGHBORHOODS)
+            traffic.append(
+                {
+                    "method": "POST",
+                    "path": "/api/receive_memo",
+                    "json": {
+                        "geo_lat": latitude,
+                        "geo_long": longitude,
+                        "memo": synthetic_memo(rng, sentences),
+                    },
+                }
+            )
+        elif kind == "get_report":
+            traffic.append({"method": "GET", "path": "/get_report"})
+        else:
+            traffic.append({"call": kind})
+    return traffic
+
+
+def read_traffic(stream: IO[str]) -> list[dict]:
+    return [json.loads(line) for line in stream if line.strip()]
+
+
+def write_traffic(traffic: Iterable[dict], stream: IO[str]) -> None:
+    for line in traffic:
+        stream.write(json.dumps(line) + "\n")
+
+
+def replay(app, traffic: list[dict], concurrency: int) -> tuple[dict, float]:
+    """Send traffic to app from concurrency threads, each with its own test client.
+
+    Returns latencies in seconds per operation (request path or call name), failed
+    requests per operation, and the wall time taken.
+    """
+    latencies: dict[str, list[float]] = {}
+    failures: dict[str, int] = {}
+    lock = threading.Lock()
+    clients = threading.local()
+
+    def send(line: dict) -> None:
+        if "call" in line:
+            operation = line["call"]
+            start = time.perf_counter()
+            CALLS[operation]()
+            ok = True
+        else:
+            operation = line["path"].split("?")[0]
+            client = getattr(clients, "client", None)
+            if client is None:
+                client = clients.client = app.test_client()
+            start = time.perf_counter()
+            response = client.open(
+                line["path"], method=line.get("method", "GET"), json=line.get("json")
+            )
+            ok = response.status_code < 400
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(operation, []).append(elapsed)
+            if not ok:
+                failures[operation] = failures.get(operation, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # list() re-raises the first exception from a worker
+        list(executor.map(send, traffic))
+    wall_seconds = time.perf_counter() - start
+    return {"latencies": latencies, "failures": failures}, wall_seconds
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], failures: int) -> dict:
+    """Latency percentiles of one operation. Operations share the replay's wall
+    time, so only the replay as a whole has a meaningful throughput."""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "failures": failures,
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
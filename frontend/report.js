@@ -1,27 +1,91 @@
 const button = document.getElementById('report');
 const content = document.getElementById("content");
 
-function getReport() {
-  const httpRequest = new XMLHttpRequest();
-  const url = '/get_report';
-
-  button.classList.add('report--loading')
-    
-  httpRequest.onreadystatechange = function() {
-    if (httpRequest.readyState === XMLHttpRequest.DONE) {
-      if (httpRequest.status === 200) {
-        const response = httpRequest.responseText;
-	button.classList.remove('report--loading')
-	button.hidden = true;
-        document.getElementById('content').innerHTML = response;
+function showReport(text) {
+  // Report text is plain text from GPT, escape it before adding line breaks
+  const escaped = text
+    .replace(/&/g, '&amp;')
+    .replace(/</g, '&lt;')
+    .replace(/>/g, '&gt;');
+  content.innerHTML = escaped.replace(/\n/g, '<br>');
+}
+
+function finishReport() {
+  button.classList.remove('report--loading');
+  button.hidden = true;
+}
+
+function failReport(message) {
+  button.classList.remove('report--loading');
+  console.error('There was a problem generating the report.', message);
+}
+
+function pollReportJob(reportJobId) {
+  // Fallback for browsers without EventSource, or when the stream drops
+  window.fetch('/api/report_jobs/' + reportJobId)
+    .then((response) => response.json())
+    .then((status) => {
+      showReport(status.output || '');
+      if (status.status === 'succeeded') {
+        finishReport();
+      } else if (status.status === 'failed') {
+        failReport(status.error);
       } else {
-        console.error('There was a problem with the request.');
+        window.setTimeout(() => pollReportJob(reportJobId), 1000);
       }
+    })
+    .catch(failReport);
+}
+
+function streamReportJob(reportJobId) {
+  if (!window.EventSource) {
+    pollReportJob(reportJobId);
+    return;
+  }
+
+  let text = '';
+  const source = new EventSource('/api/report_jobs/' + reportJobId + '/stream');
+  source.addEventListener('output', (event) => {
+    text += JSON.parse(event.data);
+    showReport(text);
+  });
+  source.addEventListener('done', (event) => {
+    source.close();
+    showReport(JSON.parse(event.data));
+    finishReport();
+  });
+  source.addEventListener('error', (event) => {
+    source.close();
+    if (event.data) {
+      failReport(JSON.parse(event.data));
+    } else {
+      pollReportJob(reportJobId);
     }
-  };
+  });
+}
 
-  httpRequest.open('GET', url);
-  httpRequest.send();
+function getReport() {
+  button.classList.add('report--loading');
+
+  // The cached report shows right away. If it is stale the server is already
+  // regenerating it, and names that job so the new report can be followed.
+  window.fetch('/get_report')
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error(response.statusText);
+      }
+      const reportJobId = response.headers.get('X-Report-Job-Id');
+      return response.text().then((html) => {
+        // Escaped by the server, with line breaks as <br>
+        content.innerHTML = html;
+        if (reportJobId) {
+          streamReportJob(reportJobId);
+        } else {
+          finishReport();
+        }
+      });
+    })
+    .catch(failReport);
 }
 
 (() => {
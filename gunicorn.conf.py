@@ -0,0 +1,58 @@
+"""gunicorn settings, used by scripts/docker_entrypoint.sh.
+
+The app is preloaded: the master imports it once and forks workers from there, so
+workers start without importing anything and share the imported code's memory.
+Per-process state (database engine and pool, memo write buffer, chat clients,
+metrics) is created lazily and reset in forked children by os.register_at_fork()
+hooks in utilities, so nothing the master touched is shared with workers.
+
+Set GUNICORN_PRELOAD=0 to have each worker import the app itself, and
+GUNICORN_PRELOAD_LLM=0 to leave the LLM stack out of the master, e.g. for
+ingest-only deployments where workers never generate reports.
+
+Workers share their metrics through METRICS_MULTIPROC_DIR (default: a directory in
+the system temp directory for this master), so /metrics on any worker serves those
+of all workers. See utilities/metrics.py.
+"""
+
+import glob
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 3000)}"
+workers = int(os.environ.get("GUNICORN_WORKERS", 4))
+# Threaded workers, so report streams and polling don't block memo ingestion
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 1080
+accesslog = "-"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+# Set before the app is loaded, so the master and every worker see it
+os.environ.setdefault(
+    "METRICS_MULTIPROC_DIR",
+    os.path.join(tempfile.gettempdir(), f"vpfg-metrics-{os.getpid()}"),
+)
+
+
+def on_starting(server):
+    # Snapshots left by a previous run would be summed into this one's metrics
+    directory = os.environ["METRICS_MULTIPROC_DIR"]
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        os.remove(path)
+
+
+def when_ready(server):
+    # Runs in the master after the app is preloaded and before workers are forked
+    if preload_app and os.environ.get("GUNICORN_PRELOAD_LLM", "1") == "1":
+        from utilities.llm.methods import preload
+
+        preload()
+        server.log.info("Preloaded LLM stack.")
+
+
+def child_exit(server, worker):
+    from utilities import metrics
+
+    metrics.mark_process_dead(worker.pid)
@@ -1,8 +1,8 @@
 #!/bin/bash
 
 # Entrypoint for running webserver and flask in both production and local env
-# Uses gunicorn to run flask process
+# Uses gunicorn to run flask process, configured in gunicorn.conf.py
 
 set -e
 
-/usr/local/bin/gunicorn -b 0.0.0.0:"$PORT" --workers 4 wsgi:app --access-logfile '-' --timeout 1080
+/usr/local/bin/gunicorn -c gunicorn.conf.py wsgi:app
@@ -0,0 +1,54 @@
+import random
+
+from utilities.llm.budget import StratifiedSampler
+
+
+def _corpus(memo_count=1000, strata_count=53, seed=0):
+    """(stratum, tokens) pairs with strata of very different sizes."""
+    rng = random.Random(seed)
+    weights = [1 / (index + 1) for index in range(strata_count)]
+    return [
+        (rng.choices(range(strata_count), weights)[0], rng.randint(20, 120))
+        for _ in range(memo_count)
+    ]
+
+
+def _sample(memos, budget):
+    strata = {}
+    for key, tokens in memos:
+        count, total = strata.get(key, (0, 0))
+        strata[key] = (count + 1, total + tokens)
+    sampler = StratifiedSampler(strata, budget)
+    kept = [(key, tokens) for key, tokens in memos if sampler.keep(key, tokens)]
+    return strata, kept
+
+
+def test_sampler_uses_budget_and_covers_strata():
+    memos = _corpus()
+    total = sum(tokens for _, tokens in memos)
+    for divisor in (50, 20, 5, 2):
+        budget = total // divisor
+        strata, kept = _sample(memos, budget)
+        used = sum(tokens for _, tokens in kept)
+        covered = len({key for key, _ in kept})
+        assert used <= budget
+        assert used >= 0.9 * budget
+        # As many strata as there are picks, up to all of them
+        assert covered >= min(len(strata), len(kept)) * 0.9
+
+
+def test_sampler_keeps_everything_within_budget():
+    memos = _corpus(memo_count=100)
+    _, kept = _sample(memos, sum(tokens for _, tokens in memos))
+    assert len(kept) == len(memos)
+
+
+def test_sampler_spreads_picks_through_a_stratum():
+    memos = [("day", 10)] * 100
+    kept_indexes = []
+    sampler = StratifiedSampler({"day": (100, 1000)}, 100)
+    for index, (key, tokens) in enumerate(memos):
+        if sampler.keep(key, tokens):
+            kept_indexes.append(index)
+    assert len(kept_indexes) == 10
+    assert kept_indexes[0] >= 4 and kept_indexes[-1] <= 95
@@ -0,0 +1,39 @@
+from utilities.llm.dedupe import collapse_near_duplicates, simhash
+from utilities.orm import seeds
+
+
+def test_non_ascii_memos_are_not_merged():
+    memos = ["日本語のメモ", "완전히 다른 메모", "🙂🙂", "...", "Ça va très bien, merci"]
+    collapsed = collapse_near_duplicates((memo, None) for memo in memos)
+    assert collapsed == [(memo, 1) for memo in memos]
+
+
+def test_non_ascii_words_are_fingerprinted():
+    assert simhash("完全に 違う メモ です") != 0
+    assert simhash("완전히 다른 메모") != simhash("완전히 같은 메모")
+
+
+def test_short_one_word_variants_are_not_merged():
+    pairs = [
+        ("No answer, left flyer, never", "No answer, left flyer, yes"),
+        ("He plans to vote never this year", "He plans to vote undecided this year"),
+        ("Supports the school bond", "Opposes the school bond"),
+    ]
+    for first, second in pairs:
+        collapsed = collapse_near_duplicates([(first, None), (second, None)])
+        assert collapsed == [(first, 1), (second, 1)]
+
+
+def test_long_one_word_variants_are_merged():
+    memo = seeds.memos[0]
+    words = memo.split()
+    words[len(words) // 2] = "neighborhood"
+    variant = " ".join(words)
+    assert collapse_near_duplicates([(memo, None), (variant, simhash(variant))]) == [
+        (memo, 2)
+    ]
+
+
+def test_distinct_seed_memos_are_kept():
+    collapsed = collapse_near_duplicates((memo, None) for memo in seeds.memos)
+    assert len(collapsed) == len(seeds.memos)
@@ -0,0 +1,75 @@
+import io
+import threading
+import time
+
+import pytest
+
+from utilities.orm.ingest import RecordError, WriteBehindBuffer, iter_json_records
+
+
+def _parse(body, chunk_size):
+    return list(iter_json_records(io.BytesIO(body.encode("utf-8")), chunk_size))
+
+
+def test_json_array_split_at_every_position():
+    body = '[1, 23, {"a": 1}, "x", true, null, 456, -0.5E+2, [1, 2], {"m": "é日"}]'
+    expected = [1, 23, {"a": 1}, "x", True, None, 456, -50.0, [1, 2], {"m": "é日"}]
+    for chunk_size in range(1, len(body) + 1):
+        assert _parse(body, chunk_size) == expected
+
+
+def test_json_array_trailing_comma_is_rejected():
+    records = _parse('[{"a": 1},]', 3)
+    assert records[0] == {"a": 1}
+    assert isinstance(records[1], RecordError)
+
+
+def test_unterminated_json_array_is_reported():
+    records = _parse("[1, 2", 2)
+    assert records[:2] == [1, 2]
+    assert isinstance(records[2], RecordError)
+
+
+def test_submit_blocked_on_backpressure_fails_after_close():
+    release = threading.Event()
+    written = []
+
+    def flush_rows(rows):
+        release.wait()
+        written.extend(rows)
+
+    buffer = WriteBehindBuffer(
+        max_rows=1, max_latency_ms=1, max_pending=1, flush_rows=flush_rows
+    )
+    errors = []
+
+    def submit(row):
+        try:
+            buffer.submit(row)
+        except RuntimeError as error:
+            errors.append((row, error))
+
+    # The first row is being flushed, the second fills the buffer, the third waits
+    producers = [threading.Thread(target=submit, args=(row,)) for row in "abc"]
+    for producer in producers:
+        producer.start()
+        time.sleep(0.05)
+    closer = threading.Thread(target=buffer.close)
+    closer.start()
+    time.sleep(0.05)
+    release.set()
+    closer.join(5)
+    for producer in producers:
+        producer.join(5)
+
+    assert not any(producer.is_alive() for producer in producers)
+    assert written == ["a", "b"]
+    assert [row for row, _ in errors] == ["c"]
+    assert buffer.stats()["pending_rows"] == 0
+
+
+def test_submit_after_close_fails():
+    buffer = WriteBehindBuffer(flush_rows=lambda rows: None)
+    buffer.close()
+    with pytest.raises(RuntimeError):
+        buffer.submit("row")
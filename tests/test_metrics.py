@@ -0,0 +1,56 @@
+import os
+
+from utilities import metrics
+
+
+def _write_worker(directory, pid, instance, requests, connections):
+    metrics._write_json(
+        os.path.join(directory, f"{pid}.json"),
+        {
+            "instance": instance,
+            "live": True,
+            "histograms": {
+                "db_query_duration_seconds": {
+                    "buckets": [0.1, 1.0],
+                    "series": [[[["operation", "query"]], [requests, 0, 0], 0.01]],
+                }
+            },
+            "collected": [
+                ["db_pool_checkouts_total", "counter", requests],
+                ["db_pool_checked_out", "gauge", connections],
+            ],
+        },
+    )
+
+
+def _lines(prefix):
+    return [line for line in metrics.render().splitlines() if line.startswith(prefix)]
+
+
+def test_exited_workers_are_folded_and_pids_can_be_reused(tmp_path, monkeypatch):
+    monkeypatch.setenv("METRICS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_collectors", [])
+    _write_worker(tmp_path, 100, "first", requests=5, connections=2)
+    _write_worker(tmp_path, 101, "second", requests=3, connections=1)
+    assert _lines("db_pool_checkouts_total") == ["db_pool_checkouts_total 8"]
+    assert len(_lines("db_pool_checked_out{")) == 2
+
+    metrics.mark_process_dead(100)
+    assert not (tmp_path / "100.json").exists()
+    assert _lines("db_pool_checkouts_total") == ["db_pool_checkouts_total 8"]
+    assert _lines("db_pool_checked_out{") == ['db_pool_checked_out{pid="101"} 1']
+    assert _lines('db_query_duration_seconds_count{operation="query"}') == [
+        'db_query_duration_seconds_count{operation="query"} 8'
+    ]
+
+    # A new worker with the same pid adds to the totals instead of replacing them
+    _write_worker(tmp_path, 100, "third", requests=1, connections=4)
+    assert _lines("db_pool_checkouts_total") == ["db_pool_checkouts_total 9"]
+    metrics.mark_process_dead(100)
+    metrics.mark_process_dead(101)
+    assert _lines("db_pool_checkouts_total") == ["db_pool_checkouts_total 9"]
+    assert _lines("db_pool_checked_out{") == []
+    assert sorted(os.listdir(tmp_path)) == [
+        f"{os.getpid()}.json",
+        metrics.EXITED_SNAPSHOT,
+    ]
@@ -0,0 +1,175 @@
+"""Geohash cells for indexing and grouping canvass results by location.
+
+A geohash interleaves longitude and latitude bits and spells them in base 32, so
+every prefix of a geohash is a cell containing it. Memos in a cell therefore form a
+contiguous range of the indexed canvassresult.geohash column, and region filters are
+index range scans:
+
+```
+lower, upper = cell_range("9ypde")
+select(CanvassResult.memo).where(
+    CanvassResult.geohash >= lower, CanvassResult.geohash < upper
+)
+```
+
+Precision 5 cells are roughly 5km across, precision 6 roughly 1km (a neighborhood),
+precision 7 roughly 150m.
+"""
+
+import math
+from typing import NamedTuple, Union
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_DECODE = {character: value for value, character in enumerate(_BASE32)}
+
+# Precision of the geohash stored with each canvass result, roughly 5m
+GEOHASH_PRECISION = 9
+
+
+class BoundingBox(NamedTuple):
+    south: float
+    west: float
+    north: float
+    east: float
+
+    def contains(self, other: "BoundingBox") -> bool:
+        return (
+            self.south <= other.south
+            and self.west <= other.west
+            and self.north >= other.north
+            and self.east >= other.east
+        )
+
+    def intersection(self, other: "BoundingBox") -> "BoundingBox":
+        return BoundingBox(
+            max(self.south, other.south),
+            max(self.west, other.west),
+            min(self.north, other.north),
+            min(self.east, other.east),
+        )
+
+
+WORLD = BoundingBox(-90.0, -180.0, 90.0, 180.0)
+
+
+def encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Geohash of a point."""
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    characters = []
+    value = bits = 0
+    even = True  # Even bits are longitude, odd bits latitude
+    while len(characters) < precision:
+        coordinate, interval = (
+            (longitude, long_range) if even else (latitude, lat_range)
+        )
+        middle = (interval[0] + interval[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            interval[0] = middle
+        else:
+            value = value * 2
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            characters.append(_BASE32[value])
+            value = bits = 0
+    return "".join(characters)
+
+
+def cell_bounds(cell: str) -> BoundingBox:
+    """Bounding box of a geohash cell."""
+    lat_range = [-90.0, 90.0]
+    long_range = [-180.0, 180.0]
+    even = True
+    for character in cell:
+        value = _DECODE[character]
+        for shift in range(4, -1, -1):
+            interval = long_range if even else lat_range
+            middle = (interval[0] + interval[1]) / 2
+            if value >> shift & 1:
+                interval[0] = middle
+            else:
+                interval[1] = middle
+            even = not even
+    return BoundingBox(lat_range[0], long_range[0], lat_range[1], long_range[1])
+
+
+def cell_range(cell: str) -> tuple[str, str]:
+    """Lower (inclusive) and upper (exclusive) geohash of the points in a cell."""
+    # "{" sorts right after "z", the last base 32 character
+    return cell, cell + "{"
+
+
+def is_cell(text: str) -> bool:
+    return 0 < len(text) <= GEOHASH_PRECISION and all(c in _DECODE for c in text)
+
+
+def cell_size(precision: int) -> tuple[float, float]:
+    """Height and width in degrees of cells of a precision."""
+    long_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 // 2
+    return 180.0 / 2**lat_bits, 360.0 / 2**long_bits
+
+
+def _grid_ranges(box: BoundingBox, precision: int) -> tuple[range, range]:
+    """Row and column numbers of the cells of a precision that overlap a box."""
+    height, width = cell_size(precision)
+    rows = range(
+        math.floor((box.south + 90) / height),
+        min(math.floor((box.north + 90) / height), round(180 / height) - 1) + 1,
+    )
+    columns = range(
+        math.floor((box.west + 180) / width),
+        min(math.floor((box.east + 180) / width), round(360 / width) - 1) + 1,
+    )
+    return rows, columns
+
+
+def covering_cells(box: BoundingBox, precision: int) -> list[str]:
+    """Geohash cells of a precision that together cover a bounding box.
+
+    The box is clipped to valid coordinates first.
+    """
+    box = box.intersection(WORLD)
+    height, width = cell_size(precision)
+    rows, columns = _grid_ranges(box, precision)
+    cells = (
+        encode(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+        for row in rows
+        for column in columns
+    )
+    # Each cell once, in case of rounding at the edges
+    return list(dict.fromkeys(cells))
+
+
+def cover_bounding_box(box: BoundingBox, max_cells: int) -> list[str]:
+    """The finest cells covering a bounding box with at most max_cells cells.
+
+    The box is clipped to valid coordinates first. Falls back to precision 1 cells
+    for boxes too large for that.
+    """
+    box = box.intersection(WORLD)
+    precision = 1
+    while precision < GEOHASH_PRECISION:
+        rows, columns = _grid_ranges(box, precision + 1)
+        if len(rows) * len(columns) > max_cells:
+            break
+        precision += 1
+    return covering_cells(box, precision)
+
+
+def geo_columns(latitude: Union[str, float], longitude: Union[str, float]) -> dict:
+    """Numeric coordinates and geohash column values for a CanvassResult.
+
+    Raises ValueError if the coordinates are not numbers in range.
+    """
+    latitude, longitude = float(latitude), float(longitude)
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError("Coordinates out of range.")
+    return {
+        "geo_lat": latitude,
+        "geo_long": longitude,
+        "geohash": encode(latitude, longitude),
+    }
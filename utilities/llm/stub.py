@@ -0,0 +1,61 @@
+"""Deterministic stand-in for the OpenAI chat model, for running offline.
+
+Select it with LLM_BACKEND=stub. Responses depend only on the messages, so reports,
+the response cache and benchmarks can be exercised without an API key. Set
+LLM_STUB_LATENCY_MS to simulate API latency.
+"""
+
+import hashlib
+import re
+import time
+from typing import TYPE_CHECKING
+
+# Imported where used, so the stub does not load langchain before it is needed
+if TYPE_CHECKING:
+    from langchain.schema import AIMessage
+
+_H2 = re.compile(r"<h2>(.*?)</h2>", re.DOTALL)
+_NUMBERING = re.compile(r"^\d+\.\s*")
+
+
+class StubChatModel:
+    """Implements the parts of the ChatOpenAI interface used in utilities.llm."""
+
+    def __init__(self, latency_ms: float = 0) -> None:
+        self.latency_ms = latency_ms
+
+    def __call__(self, messages: list) -> "AIMessage":
+        from langchain.schema import AIMessage
+
+        self._wait()
+        return AIMessage(content=self._respond(messages))
+
+    def stream(self, messages: list):
+        from langchain.schema.messages import AIMessageChunk
+
+        self._wait()
+        for word in re.findall(r"\S+\s*", self._respond(messages)):
+            yield AIMessageChunk(content=word)
+
+    def _wait(self) -> None:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    def _respond(self, messages: list) -> str:
+        prompt = messages[-1].content
+        digest = hashlib.sha256(
+            "\n".join(message.content for message in messages).encode("utf-8")
+        ).hexdigest()[:8]
+        # Quote the opening words of the first few memos or summaries as "topics"
+        items = [" ".join(item.split()[:12]) for item in _H2.findall(prompt)[:3]]
+        if not items and messages[0].type == "ai":
+            # Script recommendations for the topics in the previous response
+            items = [
+                f"Have you heard about {_NUMBERING.sub('', line)}?"
+                for line in messages[0].content.splitlines()
+                if _NUMBERING.match(line)
+            ]
+        if not items:
+            items = [" ".join(prompt.split()[:12])]
+        lines = [f"{number}. {item}" for number, item in enumerate(items, start=1)]
+        return "\n".join(lines + [f"(stub response {digest})"])
@@ -0,0 +1,441 @@
+"""Lightweight in-process latency metrics, exposed in the Prometheus text format.
+
+Code is timed with spans that record into histograms:
+
+```
+with timed("db_query_duration_seconds", operation="query"):
+    ...
+
+@timed_function("llm_call_duration_seconds", call="topics")
+def query_topics(...):
+    ...
+```
+
+Recording a span costs two perf_counter() calls, a bisect and a short lock, so it
+is cheap enough for hot paths like memo ingestion.
+
+Gauges and counters kept elsewhere (pool metrics, cache stats) are read when the
+metrics are rendered, see register_collector().
+
+When a request log is active (see start_request_spans()) spans also add their time
+to the current request, so a slow request can be broken down by stage.
+
+Metrics are kept per process. To serve them for all gunicorn workers at once, set
+METRICS_MULTIPROC_DIR to a directory shared by the workers (gunicorn.conf.py does):
+each process then writes a snapshot of its metrics to {pid}.json there every
+METRICS_WRITE_INTERVAL seconds (default 5) and at exit, and render() merges the
+snapshots. Histograms and counters are summed over all processes, and gauges are
+exported per live process with a pid label. When a worker exits (see
+mark_process_dead()) its histograms and counters are folded into exited.json and its
+own snapshot is removed, so a new process reusing its pid starts from a clean file.
+"""
+
+import atexit
+import bisect
+import contextlib
+import functools
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from fast database queries to slow GPT calls
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    30.0, 60.0,
+)
+
+HELP = {
+    "http_request_duration_seconds": "Time to handle a request, until headers are sent for streamed responses.",
+    "db_query_duration_seconds": "Time to run a query and fetch its rows.",
+    "db_write_duration_seconds": "Time to write and commit rows.",
+    "llm_stage_duration_seconds": "Time spent in report stages outside GPT calls.",
+    "llm_call_duration_seconds": "Time of GPT calls, including response cache hits.",
+}
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observations per label set."""
+
+    def __init__(self, name: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [bucket counts..., +Inf count], sum
+        self._series: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def snapshot(self) -> dict[tuple, tuple[list[int], float]]:
+        """Bucket counts (not cumulative) and sum per label set."""
+        with self._lock:
+            return {
+                labels: (list(counts), total[0])
+                for labels, (counts, total) in self._series.items()
+            }
+
+    def render(self) -> Iterator[str]:
+        return _render_histogram(self.name, self.buckets, self.snapshot())
+
+
+def _render_histogram(
+    name: str, buckets: tuple, series: dict[tuple, tuple[list[int], float]]
+) -> Iterator[str]:
+    for labels, (counts, total) in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(buckets + ("+Inf",), counts):
+            cumulative += count
+            bucket_labels = labels + (("le", str(bound)),)
+            yield f"{name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+        yield f"{name}_sum{_format_labels(labels)} {total}"
+        yield f"{name}_count{_format_labels(labels)} {cumulative}"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_histograms: dict[str, Histogram] = {}
+_histograms_lock = threading.Lock()
+
+# (prefix, function returning {name: value}, names that are counters)
+_collectors: list[tuple[str, Callable[[], dict], frozenset]] = []
+
+_request_spans = threading.local()
+
+# Whether this process has started writing snapshots to METRICS_MULTIPROC_DIR
+_writer_started = False
+# Identifies this process's snapshots, unlike its pid which may be reused
+_instance = uuid.uuid4().hex
+_writer_lock = threading.Lock()
+
+
+def _reset_after_fork() -> None:
+    # Locks may have been held mid-update at fork, and the parent's observations
+    # are not the child's. The writer thread does not survive fork either.
+    global _histograms_lock, _writer_started, _writer_lock, _instance
+
+    _histograms.clear()
+    _instance = uuid.uuid4().hex
+    _histograms_lock = threading.Lock()
+    _writer_started = False
+    _writer_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def histogram(name: str) -> Histogram:
+    existing = _histograms.get(name)
+    if existing is not None:
+        return existing
+    _start_writer()
+    with _histograms_lock:
+        return _histograms.setdefault(name, Histogram(name))
+
+
+def observe(name: str, seconds: float, **labels: str) -> None:
+    """Record one observation in the named histogram."""
+    histogram(name).observe(seconds, tuple(sorted(labels.items())))
+    spans = getattr(_request_spans, "spans", None)
+    if spans is not None:
+        key = name if not labels else f"{name}:{','.join(map(str, labels.values()))}"
+        spans[key] = spans.get(key, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels: str) -> Iterator[None]:
+    """Time the body of a with block into the named histogram, even if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed_function(name: str, **labels: str) -> Callable:
+    """Decorator form of timed()."""
+
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed(name, **labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request_spans() -> None:
+    """Collect the spans of this thread until finish_request_spans() is called."""
+    _request_spans.spans = {}
+
+
+def finish_request_spans() -> dict[str, float]:
+    """Seconds spent per span name (and labels) since start_request_spans()."""
+    spans = getattr(_request_spans, "spans", None) or {}
+    _request_spans.spans = None
+    return spans
+
+
+def request_log_enabled() -> bool:
+    """Whether REQUEST_LOG=1, for a structured log line per request."""
+    return os.environ.get("REQUEST_LOG", "0") == "1"
+
+
+def register_collector(
+    prefix: str, function: Callable[[], dict], counters: Iterable[str] = ()
+) -> None:
+    """Export the numeric values function returns as {prefix}_{name} metrics.
+
+    function is called on every render. Names in counters are exported as counters,
+    the rest as gauges.
+    """
+    _collectors.append((prefix, function, frozenset(counters)))
+
+
+def _collect() -> Iterator[tuple[str, str, float]]:
+    """(name, counter or gauge, value) of every registered collector's values."""
+    for prefix, function, counters in _collectors:
+        for key, value in function().items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            metric_type = "counter" if key in counters else "gauge"
+            name = f"{prefix}_{key}"
+            if metric_type == "counter" and not name.endswith("_total"):
+                name += "_total"
+            yield name, metric_type, value
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format.
+
+    With METRICS_MULTIPROC_DIR set these are the metrics of all processes writing
+    snapshots there, otherwise those of this process.
+    """
+    directory = multiproc_dir()
+    if directory is not None:
+        _write_snapshot(directory)
+        return _render_snapshots(directory)
+
+    lines = []
+    for name in sorted(_histograms):
+        if name in HELP:
+            lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        lines.extend(_histograms[name].render())
+
+    for name, metric_type, value in _collect():
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def multiproc_dir() -> Optional[str]:
+    """METRICS_MULTIPROC_DIR, or None if metrics are only served per process."""
+    return os.environ.get("METRICS_MULTIPROC_DIR") or None
+
+
+# Histograms and counters of exited processes
+EXITED_SNAPSHOT = "exited.json"
+
+
+def _snapshot_path(directory: str, pid: int) -> str:
+    return os.path.join(directory, f"{pid}.json")
+
+
+def _histograms_json(histograms: dict[str, tuple[tuple, dict]]) -> dict:
+    return {
+        name: {
+            "buckets": list(buckets),
+            "series": [
+                [list(labels), counts, total]
+                for labels, (counts, total) in series.items()
+            ],
+        }
+        for name, (buckets, series) in histograms.items()
+    }
+
+
+def _write_json(path: str, data: dict) -> None:
+    # Written whole then renamed, so readers never see a partial file
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # Removed or replaced meanwhile
+        return None
+
+
+def _write_snapshot(directory: str) -> None:
+    histograms = {
+        name: (histogram.buckets, histogram.snapshot())
+        for name, histogram in list(_histograms.items())
+    }
+    snapshot = {
+        "instance": _instance,
+        "live": True,
+        "histograms": _histograms_json(histograms),
+        "collected": list(_collect()),
+    }
+    _write_json(_snapshot_path(directory, os.getpid()), snapshot)
+
+
+def _read_snapshots(directory: str) -> Iterator[tuple[Optional[int], dict]]:
+    """(pid, snapshot) of every process, with pid None for the exited processes."""
+    exited = _read_json(os.path.join(directory, EXITED_SNAPSHOT))
+    folded = set()
+    if exited is not None:
+        folded = set(exited["folded"])
+        yield None, exited
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        name = os.path.basename(path).removesuffix(".json")
+        if not name.isdigit():
+            continue
+        snapshot = _read_json(path)
+        # An exited process's snapshot is in exited.json until it is removed
+        if snapshot is not None and snapshot.get("instance") not in folded:
+            yield int(name), snapshot
+
+
+def _merge_snapshots(
+    snapshots: Iterable[tuple[Optional[int], dict]],
+) -> tuple[dict[str, tuple[tuple, dict]], dict[str, float], dict[str, dict[int, float]]]:
+    """Summed histograms and counters, and the gauges of live processes by pid."""
+    histograms: dict[str, tuple[tuple, dict]] = {}
+    counters: dict[str, float] = {}
+    gauges: dict[str, dict[int, float]] = {}
+    for pid, snapshot in snapshots:
+        for name, data in snapshot["histograms"].items():
+            buckets, merged = histograms.setdefault(name, (tuple(data["buckets"]), {}))
+            for labels, counts, total in data["series"]:
+                labels = tuple(tuple(pair) for pair in labels)
+                if labels in merged:
+                    merged_counts, merged_total = merged[labels]
+                    counts = [a + b for a, b in zip(merged_counts, counts)]
+                    total += merged_total
+                merged[labels] = (counts, total)
+        for name, metric_type, value in snapshot["collected"]:
+            if metric_type == "counter":
+                counters[name] = counters.get(name, 0) + value
+            elif snapshot["live"]:
+                gauges.setdefault(name, {})[pid] = value
+    return histograms, counters, gauges
+
+
+def _render_snapshots(directory: str) -> str:
+    histograms, counters, gauges = _merge_snapshots(
+        sorted(_read_snapshots(directory), key=lambda item: item[0] or 0)
+    )
+
+    lines = []
+    for name in sorted(histograms):
+        if name in HELP:
+            lines.append(f"# HELP {name} {HELP[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        buckets, series = histograms[name]
+        lines.extend(_render_histogram(name, buckets, series))
+    for name, value in counters.items():
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    for name, values in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for pid, value in values.items():
+            lines.append(f"{name}{_format_labels((('pid', pid),))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _start_writer() -> None:
+    """Start writing this process's snapshots to METRICS_MULTIPROC_DIR, if set."""
+    global _writer_started
+
+    if _writer_started:
+        return
+    with _writer_lock:
+        if _writer_started:
+            return
+        _writer_started = True
+        directory = multiproc_dir()
+        if directory is None:
+            return
+        interval = float(os.environ.get("METRICS_WRITE_INTERVAL", 5))
+        threading.Thread(
+            target=_write_snapshots, args=(directory, interval), daemon=True
+        ).start()
+        atexit.register(_write_snapshot_quietly, directory)
+
+
+def _write_snapshots(directory: str, interval: float) -> None:
+    pid = os.getpid()
+    # Stop in a forked child, which starts its own writer
+    while os.getpid() == pid:
+        _write_snapshot_quietly(directory)
+        time.sleep(interval)
+
+
+def _write_snapshot_quietly(directory: str) -> None:
+    try:
+        _write_snapshot(directory)
+    except Exception as error:
+        logger.warning(f"Failed to write metrics snapshot. [error={error}]")
+
+
+def mark_process_dead(pid: int) -> None:
+    """Fold an exited process's histograms and counters into exited.json and remove
+    its snapshot from METRICS_MULTIPROC_DIR, dropping its gauges.
+
+    Called by the one process that reaps workers (the gunicorn master), so exited.json
+    has a single writer. Totals never go backwards: exited.json lists the snapshots it
+    already holds, and readers skip those until they are removed.
+    """
+    directory = multiproc_dir()
+    if directory is None:
+        return
+    path = _snapshot_path(directory, pid)
+    snapshot = _read_json(path)
+    if snapshot is None:
+        return
+    exited_path = os.path.join(directory, EXITED_SNAPSHOT)
+    exited = _read_json(exited_path) or {"histograms": {}, "collected": [], "folded": []}
+    if snapshot.get("instance") not in exited["folded"]:
+        histograms, counters, _ = _merge_snapshots(
+            [(None, {**exited, "live": False}), (pid, {**snapshot, "live": False})]
+        )
+        exited = {
+            "instance": None,
+            "live": False,
+            "histograms": _histograms_json(histograms),
+            "collected": [[name, "counter", value] for name, value in counters.items()],
+            # Only snapshots not yet removed need to be listed
+            "folded": [*exited["folded"][-99:], snapshot.get("instance")],
+        }
+        _write_json(exited_path, exited)
+    os.remove(path)
@@ -0,0 +1,540 @@
+"""Buffered and bulk ingestion of canvass results into the VPfG database.
+
+Committing every memo in its own transaction costs one fsync per memo and serializes
+all writers on the SQLite write lock. The write-behind buffer here collects rows from
+many request threads and commits them together ("group commit"), flushing when either
+a row count or a latency bound is reached.
+
+```
+buffer = get_memo_buffer()
+buffer.submit(canvass_result_values(record))  # returns once committed, or once queued
+```
+
+Bulk uploads (a JSON array or NDJSON body of memos) are parsed incrementally and
+inserted in chunks, so memory use does not grow with the size of the upload.
+
+```
+summary = ingest_canvass_results(iter_json_records(request.stream))
+```
+
+Exports stream memos back out as NDJSON in the same shape, see export_canvass_results().
+"""
+
+import atexit
+import codecs
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from typing import IO, Any, Callable, Iterable, Iterator, Optional
+
+import sqlalchemy
+
+from utilities.geo import geo_columns
+from utilities.llm.budget import estimate_tokens
+from utilities.llm.dedupe import simhash_columns
+from utilities.orm.methods import load_rows_to_database, stream_query
+from utilities.orm.models import CanvassResult
+from utilities.orm.partitions import created_at_window, insert_canvass_results
+
+logger = logging.getLogger(__name__)
+
+
+class _Ticket:
+    """Completion handle for one submitted row."""
+
+    def __init__(self) -> None:
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class WriteBehindBuffer:
+    """Batches rows and commits them in a single transaction.
+
+    A background thread flushes the buffer once it holds max_rows rows or once the
+    oldest row has waited max_latency_ms, whichever comes first.
+
+    With ack_after_flush=True (the default) submit() blocks until the row has been
+    committed and re-raises any error from the flush. With ack_after_flush=False it
+    returns as soon as the row is queued; rows still buffered are lost if the process
+    dies without a clean close().
+    """
+
+    def __init__(
+        self,
+        max_rows: int = 100,
+        max_latency_ms: float = 10,
+        ack_after_flush: bool = True,
+        max_pending: int = 10_000,
+        flush_rows: Callable[[list[Any]], None] = load_rows_to_database,
+    ) -> None:
+        if max_rows < 1:
+            raise ValueError("max_rows must be at least 1")
+        self.max_rows = max_rows
+        self.max_latency = max_latency_ms / 1000
+        self.ack_after_flush = ack_after_flush
+        self.max_pending = max(max_pending, max_rows)
+        self._flush_rows = flush_rows
+
+        self._pending: list[tuple[Any, _Ticket]] = []
+        self._condition = threading.Condition()
+        self._closed = False
+        self._flushed_rows = 0
+        self._flushed_batches = 0
+        self._failed_rows = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="write-behind-buffer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, row: Any) -> None:
+        """Queue one row for the next group commit."""
+        ticket = _Ticket()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Write-behind buffer is closed.")
+            while len(self._pending) >= self.max_pending:
+                # Backpressure: the database is not keeping up
+                self._condition.wait()
+                if self._closed:
+                    # The final flush may already have run, nothing would commit it
+                    raise RuntimeError("Write-behind buffer is closed.")
+            self._pending.append((row, ticket))
+            if len(self._pending) == 1 or len(self._pending) >= self.max_rows:
+                # Wake the flusher to start the latency timer or flush a full batch
+                self._condition.notify_all()
+
+        if self.ack_after_flush:
+            ticket.done.wait()
+            if ticket.error is not None:
+                raise ticket.error
+
+    def flush(self) -> None:
+        """Commit everything currently buffered and wait for it to land."""
+        with self._condition:
+            batch = self._take_batch(everything=True)
+        self._commit(batch)
+
+    def close(self) -> None:
+        """Stop accepting rows, flush what is buffered and stop the flusher thread."""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {
+                "pending_rows": len(self._pending),
+                "flushed_rows": self._flushed_rows,
+                "flushed_batches": self._flushed_batches,
+                "failed_rows": self._failed_rows,
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed:
+                    if len(self._pending) >= self.max_rows:
+                        break
+                    if self._pending:
+                        oldest = self._pending[0][1].enqueued_at
+                        remaining = oldest + self.max_latency - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                if self._closed:
+                    # close() flushes whatever is left
+                    return
+                batch = self._take_batch()
+            self._commit(batch)
+
+    def _take_batch(self, everything: bool = False) -> list[tuple[Any, _Ticket]]:
+        """Remove the next batch from the buffer. Caller holds the condition."""
+        if everything:
+            batch, self._pending = self._pending, []
+        else:
+            batch = self._pending[: self.max_rows]
+            del self._pending[: self.max_rows]
+        # Unblock producers waiting on backpressure
+        self._condition.notify_all()
+        return batch
+
+    def _commit(self, batch: list[tuple[Any, _Ticket]]) -> None:
+        if not batch:
+            return
+        failed = 0
+        try:
+            self._flush_rows([row for row, _ in batch])
+        except Exception:
+            # One bad row should not reject the whole batch, retry rows individually
+            logger.exception(
+                f"Group commit failed, retrying rows individually. [rows={len(batch)}]"
+            )
+            for row, ticket in batch:
+                try:
+                    self._flush_rows([row])
+                except Exception as error:
+                    ticket.error = error
+                    failed += 1
+            if failed:
+                logger.error(f"Dropped rows that failed to commit. [rows={failed}]")
+
+        with self._condition:
+            self._flushed_rows += len(batch) - failed
+            self._flushed_batches += 1
+            self._failed_rows += failed
+        for _, ticket in batch:
+            ticket.done.set()
+
+
+_memo_buffer: Optional[WriteBehindBuffer] = None
+_memo_buffer_lock = threading.Lock()
+
+
+def get_memo_buffer() -> WriteBehindBuffer:
+    """Process-wide write-behind buffer for incoming memos.
+
+    Configured from the environment:
+        INGEST_BATCH_ROWS: flush once this many rows are buffered (default 100)
+        INGEST_BATCH_MS: flush once the oldest row has waited this long (default 10)
+        INGEST_ACK: "flush" to acknowledge after commit (default), "enqueue" to
+            acknowledge as soon as the row is buffered
+    """
+    global _memo_buffer
+
+    if _memo_buffer is None:
+        with _memo_buffer_lock:
+            if _memo_buffer is None:
+                ack = os.environ.get("INGEST_ACK", "flush").lower()
+                if ack not in ("flush", "enqueue"):
+                    raise ValueError(f"Invalid INGEST_ACK value: {ack}")
+                _memo_buffer = WriteBehindBuffer(
+                    max_rows=int(os.environ.get("INGEST_BATCH_ROWS", 100)),
+                    max_latency_ms=float(os.environ.get("INGEST_BATCH_MS", 10)),
+                    ack_after_flush=ack == "flush",
+                    flush_rows=insert_canvass_results,
+                )
+    return _memo_buffer
+
+
+def memo_buffer_stats() -> dict[str, int]:
+    """Stats of the process-wide buffer, or {} if none was started.
+
+    Unlike get_memo_buffer().stats() this never starts a buffer (and its flusher
+    thread), e.g. in a worker that is only scraped for metrics.
+    """
+    memo_buffer = _memo_buffer
+    return memo_buffer.stats() if memo_buffer is not None else {}
+
+
+def close_memo_buffer() -> None:
+    """Flush and stop the process-wide buffer, if one was started."""
+    global _memo_buffer
+
+    with _memo_buffer_lock:
+        if _memo_buffer is not None:
+            _memo_buffer.close()
+            _memo_buffer = None
+
+
+def _reset_memo_buffer_after_fork() -> None:
+    # The flusher thread does not survive fork, so the child starts its own buffer
+    global _memo_buffer, _memo_buffer_lock
+
+    _memo_buffer = None
+    _memo_buffer_lock = threading.Lock()
+
+
+atexit.register(close_memo_buffer)
+os.register_at_fork(after_in_child=_reset_memo_buffer_after_fork)
+
+
+# Stop collecting error details past this many, only count them
+MAX_REPORTED_ERRORS = 100
+
+# A single memo record larger than this is treated as malformed input
+MAX_RECORD_BYTES = 1_000_000
+
+
+class RecordError(ValueError):
+    """A record in a bulk upload that could not be parsed or validated."""
+
+
+def canvass_result_values(record: Any) -> dict:
+    """Validate one memo record and build the column values for a CanvassResult.
+
+    Accepts `geo_lng` as an alias for `geo_long` (the recording page sends that) and
+    an optional ISO 8601 `created_at` for memos recorded offline and synced later.
+    Timestamps with an offset are converted to the server's local time, and must
+    fall in utilities.orm.partitions.created_at_window().
+    """
+    if not isinstance(record, dict):
+        raise RecordError("Record must be a JSON object.")
+
+    memo = record.get("memo")
+    if not isinstance(memo, str) or not memo.strip():
+        raise RecordError("Field 'memo' must be a non-empty string.")
+
+    geo_long = record.get("geo_long", record.get("geo_lng"))
+    for field, value in (("geo_lat", record.get("geo_lat")), ("geo_long", geo_long)):
+        if value is None:
+            raise RecordError(f"Missing field '{field}'.")
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            raise RecordError(f"Field '{field}' must be a number or string.")
+    try:
+        coordinates = geo_columns(record["geo_lat"], geo_long)
+    except ValueError:
+        raise RecordError("Fields 'geo_lat' and 'geo_long' must be valid coordinates.")
+
+    now = datetime.datetime.now()
+    created_at = record.get("created_at")
+    if created_at is None:
+        created_at = now
+    else:
+        try:
+            created_at = datetime.datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            raise RecordError("Field 'created_at' must be an ISO 8601 timestamp.")
+        if created_at.tzinfo is not None:
+            # Stored naive, in the server's local time like datetime.now()
+            created_at = created_at.astimezone().replace(tzinfo=None)
+        oldest, newest = created_at_window(now)
+        if not oldest <= created_at <= newest:
+            raise RecordError(
+                f"Field 'created_at' must be between {oldest.isoformat()} and now."
+            )
+        # Within the allowed clock skew, but memos are not recorded in the future
+        created_at = min(created_at, now)
+
+    return {
+        "canvass_result_id": str(uuid.uuid4()),
+        **coordinates,
+        "memo": memo,
+        "token_count": estimate_tokens(memo),
+        "created_at": created_at,
+        **simhash_columns(memo),
+    }
+
+
+def iter_json_records(
+    stream: IO[bytes], chunk_size: int = 64 * 1024
+) -> Iterator[Any]:
+    """Incrementally parse a JSON array or NDJSON body into records.
+
+    The format is detected from the first non-whitespace character. Only one chunk
+    plus the record being decoded is held in memory at a time. Records that fail to
+    parse are yielded as RecordError instances so the caller can report them and
+    carry on; a malformed JSON array cannot be resynchronized and ends the stream.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read_text() -> Iterator[str]:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                tail = decoder.decode(b"", final=True)
+                if tail:
+                    yield tail
+                return
+            yield decoder.decode(chunk)
+
+    chunks = read_text()
+    buffer = ""
+    for text in chunks:
+        buffer += text
+        if buffer.strip():
+            break
+    buffer = buffer.lstrip()
+    if buffer.startswith("["):
+        yield from _iter_json_array(buffer[1:], chunks)
+    else:
+        yield from _iter_ndjson(buffer, chunks)
+
+
+def _iter_ndjson(buffer: str, chunks: Iterator[str]) -> Iterator[Any]:
+    skipping = False  # Inside a line that was already reported as oversized
+    for text in itertools.chain([""], chunks):
+        buffer += text
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if skipping:
+                skipping = False
+            elif line.strip():
+                yield _parse_json_line(line)
+        if len(buffer) > MAX_RECORD_BYTES:
+            if not skipping:
+                yield RecordError("Record exceeds maximum size.")
+            skipping = True
+            buffer = ""
+    if buffer.strip() and not skipping:
+        yield _parse_json_line(buffer)
+
+
+def _parse_json_line(line: str) -> Any:
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as error:
+        return RecordError(f"Invalid JSON: {error.msg}.")
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _iter_json_array(buffer: str, chunks: Iterator[str]) -> Iterator[Any]:
+    decoder = json.JSONDecoder()
+    position = 0
+    exhausted = False
+    expect_value = True
+    after_comma = False
+    while True:
+        position = _WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if exhausted:
+                yield RecordError("Unterminated JSON array.")
+                return
+            text = next(chunks, None)
+            exhausted = text is None
+            buffer, position = text or "", 0
+            continue
+
+        if buffer[position] == "]":
+            if after_comma:
+                yield RecordError("Invalid JSON array: trailing ','.")
+            return
+        if not expect_value:
+            if buffer[position] != ",":
+                yield RecordError("Invalid JSON array: expected ',' between records.")
+                return
+            position += 1
+            expect_value = True
+            after_comma = True
+            continue
+
+        try:
+            record, position_after = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            if exhausted or len(buffer) - position > MAX_RECORD_BYTES:
+                yield RecordError(f"Invalid JSON array: {error.msg}.")
+                return
+            # Most likely the record continues in the next chunk
+            text = next(chunks, None)
+            exhausted = text is None
+            buffer, position = buffer[position:] + (text or ""), 0
+            continue
+        if not exhausted and _may_continue(record, buffer[position_after:]):
+            # A number cut off by the chunk boundary also decodes, read on first
+            text = next(chunks, None)
+            exhausted = text is None
+            buffer, position = buffer[position:] + (text or ""), 0
+            continue
+
+        yield record
+        position = position_after
+        expect_value = False
+        after_comma = False
+
+
+def _may_continue(record: Any, rest: str) -> bool:
+    """Whether a record decoded from the start of a buffer may continue past rest, the
+    remainder of the buffer, once more of the stream is read."""
+    if not rest:
+        return True
+    # "1" of "1.5" or "1e3" cut off after the "." or "e" also decodes
+    is_number = isinstance(record, (int, float)) and not isinstance(record, bool)
+    return is_number and not rest.strip("0123456789.eE+-")
+
+
+def ingest_canvass_results(records: Iterable[Any], batch_size: int = 500) -> dict:
+    """Validate memo records and insert them in chunked executemany batches.
+
+    Invalid records are skipped and reported by their zero-based position in the
+    upload; they do not abort the rest of the batch. Returns a summary:
+    ```
+    {"received": 3, "inserted": 2, "failed": 1,
+     "errors": [{"row": 1, "error": "Missing field 'geo_lat'."}]}
+    ```
+    """
+    received = inserted = failed = 0
+    errors: list[dict] = []
+
+    def record_error(row: int, message: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"row": row, "error": message})
+
+    def flush(batch: list[tuple[int, dict]]) -> None:
+        nonlocal inserted
+        try:
+            insert_canvass_results([values for _, values in batch])
+        except Exception:
+            logger.exception(f"Bulk insert failed. [rows={len(batch)}]")
+            for row, _ in batch:
+                record_error(row, "Database error while inserting record.")
+        else:
+            inserted += len(batch)
+
+    batch: list[tuple[int, dict]] = []
+    for row, record in enumerate(records):
+        received += 1
+        try:
+            if isinstance(record, RecordError):
+                raise record
+            batch.append((row, canvass_result_values(record)))
+        except RecordError as error:
+            record_error(row, str(error))
+            continue
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    flush(batch)
+
+    logger.info(
+        f"Bulk ingest complete. [received={received}, inserted={inserted}, failed={failed}]"
+    )
+    return {
+        "received": received,
+        "inserted": inserted,
+        "failed": failed,
+        "errors": errors,
+    }
+
+
+def export_canvass_results() -> Iterator[str]:
+    """Stream every canvass result as NDJSON lines, oldest first.
+
+    Rows are read in batches from a server-side cursor, so memory use does not grow
+    with the number of memos. The output can be uploaded again with
+    ingest_canvass_results().
+    """
+    rows = stream_query(
+        sqlalchemy.select(
+            CanvassResult.canvass_result_id,
+            CanvassResult.geo_lat,
+            CanvassResult.geo_long,
+            CanvassResult.memo,
+            CanvassResult.created_at,
+        ).order_by(CanvassResult.created_at)
+    )
+    for canvass_result_id, geo_lat, geo_long, memo, created_at in rows:
+        record = {
+            "canvass_result_id": canvass_result_id,
+            "geo_lat": geo_lat,
+            "geo_long": geo_long,
+            "memo": memo,
+            "created_at": created_at.isoformat(),
+        }
+        yield json.dumps(record, ensure_ascii=False) + "\n"
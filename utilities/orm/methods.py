@@ -2,18 +2,63 @@
 
 import logging
 import datetime
+import os
+import threading
+import time
 import uuid
-from typing import Union
+from typing import Iterator, Optional, Union
 
 import sqlalchemy
+import sqlalchemy.pool
 from sqlalchemy.orm import Session
-from utilities.orm.models import Base, CanvassResult
+from utilities.geo import geo_columns
+from utilities.llm.budget import estimate_tokens
+from utilities.llm.dedupe import simhash_columns
+from utilities.metrics import timed
+from utilities.orm.models import Base, BatchAnalysis, CanvassResult
 from utilities.orm import seeds
 
 import warnings
 
 logger = logging.getLogger(__name__)
 
+_engine: Optional[sqlalchemy.engine.base.Engine] = None
+_engine_lock = threading.Lock()
+
+_pool_metrics_lock = threading.Lock()
+_pool_metrics: dict[str, Union[int, float]] = {}
+
+
+def _reset_pool_metrics() -> None:
+    _pool_metrics.update(
+        checkouts=0,
+        waits=0,
+        wait_seconds_total=0.0,
+        wait_seconds_max=0.0,
+        timeouts=0,
+        overflow_peak=0,
+    )
+
+
+def _reset_engine_after_fork() -> None:
+    """Give a forked child its own engine and counters.
+
+    Pooled connections inherited from the parent must not be used or closed by the
+    child, so they are dropped without closing and the next get_engine() reconnects.
+    """
+    global _engine, _engine_lock, _pool_metrics_lock
+
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _engine = None
+    _engine_lock = threading.Lock()
+    _pool_metrics_lock = threading.Lock()
+    _reset_pool_metrics()
+
+
+_reset_pool_metrics()
+os.register_at_fork(after_in_child=_reset_engine_after_fork)
+
 
 def create_new_tables() -> None:
     """Creates new tables in database.
@@ -22,7 +67,118 @@ def create_new_tables() -> None:
 
     This does not recreate tables that already exist. The simplest method to do that (assuming total data loss in the table is acceptable) is to run delete_table() followed by create_new_tables()
     """
-    Base.metadata.create_all(get_engine())
+    # partitions builds on this module
+    from utilities.orm.partitions import create_partitioned_storage
+
+    engine = get_engine()
+    # canvassresult is a view over per-day partitions, see utilities.orm.partitions
+    tables = [
+        table
+        for table in Base.metadata.sorted_tables
+        if table is not CanvassResult.__table__
+    ]
+    Base.metadata.create_all(engine, tables=tables)
+    add_missing_columns(engine, tables)
+    drop_removed_indexes(engine, tables)
+    create_partitioned_storage(engine)
+    backfill_geohashes(engine)
+
+
+def add_missing_columns(
+    engine: sqlalchemy.engine.base.Engine,
+    tables: Optional[list[sqlalchemy.Table]] = None,
+) -> None:
+    """Bring existing tables up to date with nullable columns and indexes added to
+    the models since the tables were created.
+
+    create_all() skips tables that already exist, so without this an existing
+    database would be missing newer columns. Only additive changes are handled.
+    Defaults to every table of the models.
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table in tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    raise ValueError(
+                        f"Cannot add non-nullable column {table.name}.{column.name}"
+                    )
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    sqlalchemy.text(
+                        f"alter table {table.name} add column {column.name} {column_type}"
+                    )
+                )
+                logger.info(f"Added column. [table={table.name}, column={column.name}]")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+
+def drop_removed_indexes(
+    engine: sqlalchemy.engine.base.Engine,
+    tables: Optional[list[sqlalchemy.Table]] = None,
+) -> None:
+    """Drop indexes on columns removed from the models, so writes stop maintaining
+    them. The columns themselves are left in place.
+
+    Defaults to every table of the models.
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    inspector = sqlalchemy.inspect(engine)
+    with engine.begin() as connection:
+        for table in tables:
+            if not inspector.has_table(table.name):
+                continue
+            for index in inspector.get_indexes(table.name):
+                if all(
+                    column is None or column in table.c
+                    for column in index["column_names"]
+                ):
+                    continue
+                connection.execute(sqlalchemy.text(f"drop index {index['name']}"))
+                logger.info(f"Dropped index. [table={table.name}, index={index['name']}]")
+
+
+def backfill_geohashes(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Compute the geohash of canvass results stored before it was added.
+
+    Rows whose coordinates are not valid numbers are left without a geohash, and
+    so are left out of region reports.
+    """
+    from utilities.orm.partitions import list_partitions, partition_table
+
+    for name in list_partitions():
+        table = partition_table(name)
+        rows = query(
+            sqlalchemy.select(
+                table.c.canvass_result_id, table.c.geo_lat, table.c.geo_long
+            ).where(table.c.geohash.is_(None))
+        )
+        updates = []
+        for canvass_result_id, geo_lat, geo_long in rows:
+            try:
+                geohash = geo_columns(geo_lat, geo_long)["geohash"]
+            except (TypeError, ValueError):
+                continue
+            updates.append({"id": canvass_result_id, "geohash": geohash})
+        if not updates:
+            continue
+        with engine.begin() as connection:
+            connection.execute(
+                table.update()
+                .where(table.c.canvass_result_id == sqlalchemy.bindparam("id"))
+                .values(geohash=sqlalchemy.bindparam("geohash")),
+                updates,
+            )
+        logger.info(f"Backfilled geohashes. [table={name}, rows={len(updates)}]")
 
 
 def get_session() -> Session:
@@ -46,12 +202,17 @@ def get_session() -> Session:
     ```
     """
     engine = get_engine()
-    session = sqlalchemy.orm.Session(engine)
+    # Keep loaded attributes usable after commit, once the session is closed
+    session = sqlalchemy.orm.Session(engine, expire_on_commit=False)
     return session
 
 
 def get_engine() -> sqlalchemy.engine.base.Engine:
-    """Fetch a SQLAlchemy engine connected to the VPfG postgres database.
+    """Fetch the process-wide SQLAlchemy engine connected to the VPfG database.
+
+    The engine (and its connection pool) is created on first use and reused for the
+    life of the process. After a fork (e.g. gunicorn workers) the child builds its own
+    engine rather than sharing pooled connections with the parent.
 
     Intended usage:
     ```
@@ -59,11 +220,114 @@ def get_engine() -> sqlalchemy.engine.base.Engine:
         response = connection.execute('select * from some_table')
         result = response.fetchall()
     ```
+
+    Configured from the environment:
+        DATABASE_URL: SQLAlchemy URL, defaults to sqlite:///hackathon.db
+        DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_TIMEOUT: QueuePool sizing
+        DB_BUSY_TIMEOUT_MS: how long SQLite waits on a locked database
+        DB_SYNCHRONOUS: SQLite synchronous pragma, NORMAL is durable under WAL
+    """
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine()
+    return _engine
+
+
+def dispose_engine() -> None:
+    """Close all pooled connections and drop the process-wide engine.
+
+    The next call to get_engine() builds a fresh engine.
+    """
+    global _engine
+
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+
+
+def get_pool_metrics() -> dict[str, Union[int, float]]:
+    """Connection pool counters for the current process.
+
+    checkouts: connections handed out by the pool
+    waits: checkouts that had to block waiting for a free connection
+    wait_seconds_total / wait_seconds_max: time spent blocked in checkout
+    timeouts: checkouts that gave up after DB_POOL_TIMEOUT
+    checked_out / overflow: current pool state, overflow_peak is the high-water mark
     """
-    pool = sqlalchemy.create_engine(
-        "sqlite:///hackathon.db",
+    with _pool_metrics_lock:
+        metrics = dict(_pool_metrics)
+    engine = _engine
+    if engine is not None and isinstance(engine.pool, _MeteredQueuePool):
+        metrics["pool_size"] = engine.pool.size()
+        metrics["checked_out"] = engine.pool.checkedout()
+        metrics["overflow"] = max(engine.pool.overflow(), 0)
+    return metrics
+
+
+class _MeteredQueuePool(sqlalchemy.pool.QueuePool):
+    """QueuePool that records checkout contention in _pool_metrics."""
+
+    def _do_get(self):
+        # Checkout only blocks when nothing is idle and overflow is exhausted
+        must_wait = (
+            self._pool.empty()
+            and self._max_overflow > -1
+            and self.overflow() >= self._max_overflow
+        )
+        start = time.perf_counter()
+        try:
+            entry = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            with _pool_metrics_lock:
+                _pool_metrics["timeouts"] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with _pool_metrics_lock:
+            _pool_metrics["checkouts"] += 1
+            if must_wait:
+                _pool_metrics["waits"] += 1
+                _pool_metrics["wait_seconds_total"] += elapsed
+                _pool_metrics["wait_seconds_max"] = max(
+                    _pool_metrics["wait_seconds_max"], elapsed
+                )
+            _pool_metrics["overflow_peak"] = max(
+                _pool_metrics["overflow_peak"], self.overflow()
+            )
+        return entry
+
+
+def _create_engine() -> sqlalchemy.engine.base.Engine:
+    url = os.environ.get("DATABASE_URL", "sqlite:///hackathon.db")
+    engine = sqlalchemy.create_engine(
+        url,
+        poolclass=_MeteredQueuePool,
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
     )
-    return pool
+
+    if engine.dialect.name == "sqlite":
+        busy_timeout_ms = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+        synchronous = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+        if synchronous not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"Invalid DB_SYNCHRONOUS value: {synchronous}")
+
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # WAL lets readers proceed while a writer holds the lock, and with
+            # synchronous=NORMAL only checkpoints fsync rather than every commit
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute(f"PRAGMA busy_timeout={busy_timeout_ms}")
+            cursor.close()
+
+    logger.info(f"Created database engine. [url={engine.url!r}, pid={os.getpid()}]")
+    return engine
 
 
 def load_rows_to_database(row_objects: Union[list[Base], Base]) -> None:
@@ -77,16 +341,39 @@ def load_rows_to_database(row_objects: Union[list[Base], Base]) -> None:
     if isinstance(row_objects, Base):
         row_objects = [row_objects]
 
-    with get_session() as session:
-        for row_object in row_objects:
-            session.add(row_object)
-        session.commit()
+    with timed("db_write_duration_seconds", operation="load_rows"):
+        with get_session() as session:
+            for row_object in row_objects:
+                session.add(row_object)
+            session.commit()
 
     logger.info(f"Loaded rows to database. [rows={len(row_objects)}]")
 
 
+def insert_rows(table: sqlalchemy.Table, rows: list[dict]) -> None:
+    """Insert plain dicts into a table in one transaction with executemany.
+
+    Cheaper than load_rows_to_database() for large batches since no ORM objects or
+    unit-of-work bookkeeping are involved.
+
+    ```
+    insert_rows(LLMResponse.__table__, [{"cache_key": ..., "response": ...}])
+    ```
+    Canvass results go through utilities.orm.partitions.insert_canvass_results().
+    """
+    if not rows:
+        return
+    with timed("db_write_duration_seconds", operation="insert_rows"):
+        with get_engine().begin() as connection:
+            connection.execute(table.insert(), rows)
+
+    logger.info(f"Inserted rows to database. [table={table.name}, rows={len(rows)}]")
+
+
 def query(
-    sql: str, parameters: Union[list, dict, None] = None, commit: bool = False
+    sql: Union[str, sqlalchemy.Executable],
+    parameters: Union[list, dict, None] = None,
+    commit: bool = False,
 ) -> list[sqlalchemy.engine.row.Row] | None:
     """Execute SQL query directly against VPfG postgres database.
 
@@ -103,37 +390,92 @@ def query(
         parameters={'names': names}
     )
     ```
+
+    SQLAlchemy Core statements are accepted as well, which gives typed parameters
+    and results (e.g. datetimes rather than strings from SQLite):
+    ```
+    result = query(select(CanvassResult.memo).where(CanvassResult.created_at > since))
+    ```
     """
-    with get_engine().connect() as connection:
-        response = connection.execute(sqlalchemy.text(sql), parameters=parameters)
-        if commit:
-            connection.commit()
-    try:
-        result = response.fetchall()
-    except sqlalchemy.exc.ResourceClosedError:
-        # Some queries, like create table statements, have no return
-        result = None
+    if isinstance(sql, str):
+        sql = sqlalchemy.text(sql)
+    with timed("db_query_duration_seconds", operation="query"):
+        with get_engine().connect() as connection:
+            response = connection.execute(sql, parameters=parameters)
+            try:
+                result = response.fetchall()
+            except sqlalchemy.exc.ResourceClosedError:
+                # Some queries, like create table statements, have no return
+                result = None
+            if commit:
+                connection.commit()
     return result
 
 
+def stream_query(
+    sql: Union[str, sqlalchemy.Executable],
+    parameters: Union[list, dict, None] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator[sqlalchemy.engine.row.Row]:
+    """Like query(), but yields rows as they are read instead of fetching them all.
+
+    Rows are fetched from a server-side cursor batch_size at a time (default
+    DB_STREAM_BATCH_SIZE, 1000) while the connection stays open, so only one batch
+    is in memory at once. The connection is held until the generator is exhausted or
+    closed, so consume it promptly.
+    ```
+    for (memo,) in stream_query("select memo from canvassresult"):
+        ...
+    ```
+    """
+    if batch_size is None:
+        batch_size = int(os.environ.get("DB_STREAM_BATCH_SIZE", 1000))
+    if isinstance(sql, str):
+        sql = sqlalchemy.text(sql)
+    with get_engine().connect() as connection:
+        # Only the query itself is timed, not the caller's work between batches
+        with timed("db_query_duration_seconds", operation="stream"):
+            response = connection.execution_options(
+                stream_results=True, yield_per=batch_size
+            ).execute(sql, parameters=parameters)
+        for partition in response.partitions():
+            yield from partition
+
+
 def seed_database_with_canvass_results():
+    from utilities.orm.partitions import insert_canvass_results
+
     canvass_results = []
     for memo in seeds.memos:
-        canvass_result = CanvassResult(
-            geo_lat=1,
-            geo_long=2,
-            memo=memo,
-            created_at=datetime.datetime.now(),
-            canvass_result_id=str(uuid.uuid4()),
+        canvass_results.append(
+            {
+                **geo_columns(1, 2),
+                "memo": memo,
+                "token_count": estimate_tokens(memo),
+                "created_at": datetime.datetime.now(),
+                "canvass_result_id": str(uuid.uuid4()),
+                **simhash_columns(memo),
+            }
+        )
+    insert_canvass_results(canvass_results)
+
+
+def fetch_latest_batch_analysis() -> Optional[BatchAnalysis]:
+    """Most recent batch analysis over all memos, or None if no report has been
+    generated yet."""
+    with get_session() as session:
+        return (
+            session.query(BatchAnalysis)
+            .filter(BatchAnalysis.days.is_(None))
+            .order_by(BatchAnalysis.created_at.desc())
+            .first()
         )
-        canvass_results.append(canvass_result)
-    load_rows_to_database(canvass_results)
 
 
 def fetch_report() -> str:
     """Assemble report based on latest batch analysis."""
     query_response = query(
-        "select gpt_output from batchanalysis order by created_at desc limit 1"
+        "select gpt_output from batchanalysis where days is null order by created_at desc limit 1"
     )
     result = query_response[0][0]
     return result
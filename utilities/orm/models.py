@@ -70,9 +70,9 @@ with get_session() as session:
 """
 
 import datetime
-from typing import Literal
+from typing import Literal, Optional
 
-from sqlalchemy import Column, ForeignKey, String, Table
+from sqlalchemy import BigInteger, Column, ForeignKey, LargeBinary, String, Table
 from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
@@ -84,10 +84,20 @@ class Base(DeclarativeBase):
 class CanvassResult(Base):
     __tablename__ = "canvassresult"
     canvass_result_id: Mapped[str] = mapped_column(primary_key=True)
-    geo_lat: Mapped[str]
-    geo_long: Mapped[str]
+    geo_lat: Mapped[float]
+    geo_long: Mapped[float]
+    # Geohash of geo_lat/geo_long, so region filters are index range scans, see
+    # utilities.geo
+    geohash: Mapped[Optional[str]] = mapped_column(String(12), index=True)
     memo: Mapped[str]
-    created_at: Mapped[datetime.datetime]
+    # Estimated tokens of the memo, see utilities.llm.budget
+    token_count: Mapped[Optional[int]]
+    created_at: Mapped[datetime.datetime] = mapped_column(index=True)
+    # Position in commit order, assigned when the row is inserted. Unlike created_at,
+    # which synced memos backdate, it only grows. See utilities.orm.partitions.
+    ingest_sequence: Mapped[Optional[int]] = mapped_column(BigInteger, index=True)
+    # SimHash of the memo, see utilities.llm.dedupe
+    simhash: Mapped[Optional[int]] = mapped_column(BigInteger)
 
 
 class BatchAnalysis(Base):
@@ -96,3 +106,77 @@ class BatchAnalysis(Base):
     gpt_input_prompt: Mapped[str]
     gpt_output: Mapped[str]
     created_at: Mapped[datetime.datetime]
+    # Topics before the script recommendations, merged into by incremental reports
+    gpt_topics: Mapped[Optional[str]]
+    # Latest canvassresult.created_at covered, and how many memos were covered
+    memo_watermark: Mapped[Optional[datetime.datetime]]
+    memo_count: Mapped[Optional[int]]
+    # Latest canvassresult.ingest_sequence covered, incremental reports continue
+    # from here
+    memo_sequence: Mapped[Optional[int]] = mapped_column(BigInteger)
+    # When the analysis this one builds on was last generated from all memos
+    full_rebuild_at: Mapped[Optional[datetime.datetime]]
+    # Memos and memo tokens actually sent to GPT, fewer than memo_count (or the new
+    # memos of an incremental report) when sampled to fit the token budget
+    sampled_memo_count: Mapped[Optional[int]]
+    sampled_token_count: Mapped[Optional[int]]
+    # Set for reports on only the memos of the last this many days, which are not
+    # the latest report and which incremental reports do not build on
+    days: Mapped[Optional[int]]
+
+
+class RegionSummary(Base):
+    __tablename__ = "regionsummary"
+    # A geohash cell, or a cell clipped to a bounding box as "cell:s,w,n,e"
+    region: Mapped[str] = mapped_column(primary_key=True)
+    gpt_topics: Mapped[str]
+    # Count and latest created_at of the memos in the region when summarized
+    memo_count: Mapped[int]
+    memo_watermark: Mapped[datetime.datetime]
+    created_at: Mapped[datetime.datetime]
+
+
+class ReportJob(Base):
+    __tablename__ = "reportjob"
+    report_job_id: Mapped[str] = mapped_column(primary_key=True)
+    # pending, running, succeeded or failed
+    status: Mapped[str] = mapped_column(index=True)
+    # Which LLM stage is running: summarizing, topics or recommendations
+    stage: Mapped[Optional[str]]
+    full_rebuild: Mapped[bool]
+    # Report text generated so far, the complete report once succeeded
+    output: Mapped[str]
+    error: Mapped[Optional[str]]
+    batch_analysis_id: Mapped[Optional[str]]
+    created_at: Mapped[datetime.datetime]
+    updated_at: Mapped[datetime.datetime]
+
+
+class LLMResponse(Base):
+    __tablename__ = "llmresponse"
+    # sha256 of backend, model, temperature and messages, see utilities.llm.cache
+    cache_key: Mapped[str] = mapped_column(primary_key=True)
+    model_name: Mapped[str]
+    response: Mapped[str]
+    created_at: Mapped[datetime.datetime] = mapped_column(index=True)
+    last_used_at: Mapped[datetime.datetime] = mapped_column(index=True)
+
+
+class TopicModelState(Base):
+    __tablename__ = "topicmodelstate"
+    topic_model_state_id: Mapped[str] = mapped_column(primary_key=True)
+    # utilities.llm.clustering.TopicModel as a numpy .npz archive
+    state: Mapped[bytes] = mapped_column(LargeBinary)
+    memo_watermark: Mapped[Optional[datetime.datetime]]
+    # Latest canvassresult.ingest_sequence folded in
+    memo_sequence: Mapped[Optional[int]] = mapped_column(BigInteger)
+    memo_count: Mapped[int]
+    created_at: Mapped[datetime.datetime] = mapped_column(index=True)
+
+
+class IngestSequence(Base):
+    __tablename__ = "ingestsequence"
+    # Name of the table the counter numbers rows of
+    name: Mapped[str] = mapped_column(primary_key=True)
+    # Last number handed out
+    value: Mapped[int] = mapped_column(BigInteger)
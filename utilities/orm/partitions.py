@@ -0,0 +1,422 @@
+"""Per-day partitions of canvass results.
+
+Canvass results are stored in one table per day, canvassresult_YYYYMMDD, each with
+the columns and indexes of CanvassResult. canvassresult itself is a view over all of
+them (UNION ALL), so reads through the CanvassResult model work unchanged; SQLite
+pushes filters such as created_at ranges down into each partition's indexes.
+
+Writes go through insert_canvass_results(), which routes rows to their day's table
+and creates it on first use, and numbers rows in commit order (ingest_sequence):
+
+```
+insert_canvass_results([canvass_result_values(record) for record in records])
+```
+
+Purging and retention drop whole partitions instead of deleting rows one at a time,
+so they hold the write lock only for a few schema changes and memo ingestion carries
+on around them. MEMO_RETENTION_DAYS (unset by default, keep everything) drops days
+older than that as new days start.
+
+Partitions are only created for days in created_at_window(), so a stray timestamp
+cannot create tables for arbitrary days.
+
+canvass_results(since) selects from the partitions from a day on only, for queries
+over recent memos that should not touch older partitions at all.
+
+SQLite limits a compound select to 500 terms, so unions over more partitions than
+that are built from nested groups of at most 500.
+"""
+
+import contextlib
+import datetime
+import itertools
+import logging
+import os
+import re
+import threading
+from typing import Iterable, Iterator, Optional
+
+import sqlalchemy
+from sqlalchemy.orm import aliased
+
+from utilities.metrics import timed
+from utilities.orm.methods import (
+    add_missing_columns,
+    drop_removed_indexes,
+    get_engine,
+    query,
+)
+from utilities.orm.models import CanvassResult, IngestSequence
+
+logger = logging.getLogger(__name__)
+
+VIEW_NAME = CanvassResult.__tablename__
+_PARTITION_NAME = re.compile(rf"^{VIEW_NAME}_(\d{{8}})$")
+
+# Terms per compound select, SQLite's limit
+_UNION_GROUP_SIZE = 500
+
+# Memos older than this are refused, unless MEMO_RETENTION_DAYS is lower
+DEFAULT_MAX_MEMO_AGE_DAYS = 365
+# How far memo timestamps may be ahead of the server clock
+MAX_CLOCK_SKEW = datetime.timedelta(minutes=10)
+
+_metadata = sqlalchemy.MetaData()
+_partition_tables: dict[str, sqlalchemy.Table] = {}
+# Partitions this process has created or seen, so inserts skip the existence check
+_known_partitions: set[str] = set()
+_partitions_lock = threading.Lock()
+
+
+def _reset_partitions_after_fork() -> None:
+    global _partitions_lock
+
+    _known_partitions.clear()
+    _partitions_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_partitions_after_fork)
+
+
+def partition_name(day: datetime.date) -> str:
+    return f"{VIEW_NAME}_{day:%Y%m%d}"
+
+
+def partition_day(name: str) -> datetime.date:
+    return datetime.datetime.strptime(_PARTITION_NAME.match(name).group(1), "%Y%m%d").date()
+
+
+def created_at_window(
+    now: Optional[datetime.datetime] = None,
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """Oldest and newest created_at accepted for a memo.
+
+    Memos may be up to MEMO_MAX_AGE_DAYS (default 365) or MEMO_RETENTION_DAYS old,
+    whichever is lower, and up to MAX_CLOCK_SKEW ahead of now.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    max_age_days = int(os.environ.get("MEMO_MAX_AGE_DAYS", DEFAULT_MAX_MEMO_AGE_DAYS))
+    if os.environ.get("MEMO_RETENTION_DAYS"):
+        max_age_days = min(max_age_days, int(os.environ["MEMO_RETENTION_DAYS"]))
+    oldest = datetime.datetime.combine(
+        now.date() - datetime.timedelta(days=max_age_days), datetime.time()
+    )
+    return oldest, now + MAX_CLOCK_SKEW
+
+
+def partition_table(name: str) -> sqlalchemy.Table:
+    """Table object for a partition, with CanvassResult's columns and indexes."""
+    with _partitions_lock:
+        table = _partition_tables.get(name)
+        if table is None:
+            # Copied columns keep index=True, so each gets its ix_{name}_{column} index
+            columns = [column._copy() for column in CanvassResult.__table__.columns]
+            table = sqlalchemy.Table(name, _metadata, *columns)
+            _partition_tables[name] = table
+        return table
+
+
+def list_partitions(connection: Optional[sqlalchemy.Connection] = None) -> list[str]:
+    """Names of the partition tables in the database, oldest first."""
+    inspector = sqlalchemy.inspect(connection if connection is not None else get_engine())
+    return sorted(name for name in inspector.get_table_names() if _PARTITION_NAME.match(name))
+
+
+@contextlib.contextmanager
+def _schema_transaction() -> Iterator[sqlalchemy.Connection]:
+    """Transaction for partition DDL that takes the write lock up front.
+
+    pysqlite only opens transactions implicitly for DML, so without this concurrent
+    workers could interleave creating partitions and rebuilding the view, and a
+    view could miss a partition.
+    """
+    engine = get_engine()
+    if engine.dialect.name != "sqlite":
+        with engine.begin() as connection:
+            yield connection
+        return
+
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.exec_driver_sql("begin immediate")
+        try:
+            yield connection
+        except BaseException:
+            connection.exec_driver_sql("rollback")
+            raise
+        connection.exec_driver_sql("commit")
+
+
+def _union_partitions(names: list[str]) -> sqlalchemy.Select:
+    """UNION ALL of the CanvassResult columns of partitions.
+
+    More than _UNION_GROUP_SIZE partitions are unioned in groups, each group a
+    subquery, so no compound select has too many terms. SQLite still pushes filters
+    down into every partition.
+    """
+    columns = [column.name for column in CanvassResult.__table__.columns]
+    if not names:
+        # An empty select with the right columns
+        return sqlalchemy.select(
+            *(sqlalchemy.null().label(column) for column in columns)
+        ).where(sqlalchemy.false())
+
+    selects = [
+        sqlalchemy.select(*(partition_table(name).c[column] for column in columns))
+        for name in names
+    ]
+    while len(selects) > _UNION_GROUP_SIZE:
+        selects = [
+            sqlalchemy.select(
+                sqlalchemy.union_all(*selects[start : start + _UNION_GROUP_SIZE])
+                .subquery()
+                .c
+            )
+            for start in range(0, len(selects), _UNION_GROUP_SIZE)
+        ]
+    return sqlalchemy.union_all(*selects) if len(selects) > 1 else selects[0]
+
+
+def _rebuild_view(connection: sqlalchemy.Connection) -> None:
+    body = _union_partitions(list_partitions(connection))
+    sql = body.compile(connection, compile_kwargs={"literal_binds": True})
+    connection.exec_driver_sql(f"drop view if exists {VIEW_NAME}")
+    connection.exec_driver_sql(f"create view {VIEW_NAME} as {sql}")
+
+
+def ensure_partitions(days: set[datetime.date]) -> None:
+    """Create the partitions for days that do not exist yet.
+
+    Raises ValueError for days outside created_at_window().
+    """
+    missing = {day for day in days if partition_name(day) not in _known_partitions}
+    if not missing:
+        return
+    oldest, newest = created_at_window()
+    outside = sorted(day for day in missing if not oldest.date() <= day <= newest.date())
+    if outside:
+        raise ValueError(f"Memo days outside the accepted window: {outside}")
+
+    with _schema_transaction() as connection:
+        existing = set(list_partitions(connection))
+        created = []
+        for day in sorted(missing):
+            name = partition_name(day)
+            if name not in existing:
+                partition_table(name).create(connection)
+                created.append(name)
+        if created:
+            _rebuild_view(connection)
+    with _partitions_lock:
+        _known_partitions.update(partition_name(day) for day in missing)
+
+    if created:
+        logger.info(f"Created memo partitions. [partitions={created}]")
+        # A new day started. Days just created are kept even if they expired since
+        # their memos were validated, so the insert does not fail
+        drop_expired_partitions(keep=created)
+
+
+def reserve_ingest_sequence(connection: sqlalchemy.Connection, count: int) -> int:
+    """Reserve count ingest sequence numbers in connection's transaction, returns the
+    first.
+
+    The counter row stays locked until the transaction ends, so numbers increase in
+    commit order: rows committed after a reader's snapshot always get numbers above
+    every row it saw.
+    """
+    table = IngestSequence.__table__
+    updated = connection.execute(
+        table.update()
+        .where(table.c.name == VIEW_NAME)
+        .values(value=table.c.value + count)
+    )
+    if not updated.rowcount:
+        connection.execute(table.insert().values(name=VIEW_NAME, value=count))
+        return 1
+    last = connection.execute(
+        sqlalchemy.select(table.c.value).where(table.c.name == VIEW_NAME)
+    ).scalar_one()
+    return last - count + 1
+
+
+def insert_canvass_results(rows: list[dict]) -> None:
+    """Insert canvass result column values, each into its created_at day's partition.
+
+    All rows are inserted in one transaction, numbered in the order given.
+    """
+    if not rows:
+        return
+
+    def day(row: dict) -> datetime.date:
+        return row["created_at"].date()
+
+    days = {day(row) for row in rows}
+    for attempt in range(2):
+        ensure_partitions(days)
+        try:
+            with timed("db_write_duration_seconds", operation="insert_canvass_results"):
+                with get_engine().begin() as connection:
+                    # Taken first, so the transaction holds the write lock throughout
+                    first = reserve_ingest_sequence(connection, len(rows))
+                    numbered = [
+                        {**row, "ingest_sequence": sequence}
+                        for sequence, row in enumerate(rows, start=first)
+                    ]
+                    for day_, day_rows in itertools.groupby(
+                        sorted(numbered, key=day), key=day
+                    ):
+                        connection.execute(
+                            partition_table(partition_name(day_)).insert(),
+                            list(day_rows),
+                        )
+        except sqlalchemy.exc.OperationalError as error:
+            # Purged by another worker since this one saw it, create it again
+            if attempt or "no such table" not in str(error):
+                raise
+            with _partitions_lock:
+                _known_partitions.clear()
+        else:
+            break
+
+    logger.info(
+        f"Inserted rows to database. [table={VIEW_NAME}, rows={len(rows)}, partitions={len(days)}]"
+    )
+
+
+def drop_partitions(names: list[str]) -> None:
+    """Drop partitions and everything in them."""
+    if not names:
+        return
+    with _schema_transaction() as connection:
+        for name in names:
+            connection.exec_driver_sql(f"drop table if exists {name}")
+        _rebuild_view(connection)
+    with _partitions_lock:
+        _known_partitions.difference_update(names)
+    logger.info(f"Dropped memo partitions. [partitions={names}]")
+
+
+def purge_canvass_results() -> int:
+    """Delete every canvass result by dropping all partitions.
+
+    Returns how many partitions were dropped.
+    """
+    names = list_partitions()
+    drop_partitions(names)
+    return len(names)
+
+
+def drop_expired_partitions(
+    retention_days: Optional[int] = None, keep: Iterable[str] = ()
+) -> list[str]:
+    """Drop partitions older than retention_days (default MEMO_RETENTION_DAYS),
+    except those in keep.
+
+    Does nothing if no retention is configured. Returns the dropped partitions.
+    """
+    if retention_days is None:
+        if not os.environ.get("MEMO_RETENTION_DAYS"):
+            return []
+        retention_days = int(os.environ["MEMO_RETENTION_DAYS"])
+    cutoff = datetime.date.today() - datetime.timedelta(days=retention_days)
+    expired = [
+        name
+        for name in list_partitions()
+        if partition_day(name) < cutoff and name not in keep
+    ]
+    drop_partitions(expired)
+    return expired
+
+
+def canvass_results(since: Optional[datetime.datetime] = None):
+    """CanvassResult, or if since is given an alias of it over only the partitions
+    that can hold memos created at or after since.
+
+    Use its attributes like CanvassResult's:
+    ```
+    recent = canvass_results(since=datetime.datetime.now() - datetime.timedelta(days=7))
+    query(select(recent.memo).where(recent.created_at >= since))
+    ```
+    The caller still filters on created_at within the first day.
+    """
+    if since is None:
+        return CanvassResult
+    body = _union_partitions(
+        [name for name in list_partitions() if partition_day(name) >= since.date()]
+    )
+    # The partitions' columns are copies, matched to CanvassResult's by name
+    return aliased(CanvassResult, body.subquery(VIEW_NAME), adapt_on_names=True)
+
+
+def create_partitioned_storage(engine: sqlalchemy.engine.base.Engine) -> None:
+    """Bring canvass result storage up to date, called by create_new_tables().
+
+    Moves the rows of a canvassresult table from before partitioning into per-day
+    partitions, brings every partition's columns and indexes up to date with
+    CanvassResult, rebuilds the view over them and numbers rows stored before
+    ingest_sequence.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    if VIEW_NAME in inspector.get_table_names():
+        _partition_legacy_table(engine)
+
+    partitions = [partition_table(name) for name in list_partitions()]
+    add_missing_columns(engine, partitions)
+    drop_removed_indexes(engine, partitions)
+    with _schema_transaction() as connection:
+        _rebuild_view(connection)
+    drop_expired_partitions()
+    _backfill_ingest_sequence()
+
+
+def _backfill_ingest_sequence() -> None:
+    # Oldest first, so existing rows keep their created_at order
+    for name in list_partitions():
+        table = partition_table(name)
+        with _schema_transaction() as connection:
+            ids = connection.execute(
+                sqlalchemy.select(table.c.canvass_result_id)
+                .where(table.c.ingest_sequence.is_(None))
+                .order_by(table.c.created_at)
+            ).scalars().all()
+            if not ids:
+                continue
+            first = reserve_ingest_sequence(connection, len(ids))
+            connection.execute(
+                table.update()
+                .where(table.c.canvass_result_id == sqlalchemy.bindparam("id"))
+                .values(ingest_sequence=sqlalchemy.bindparam("sequence")),
+                [
+                    {"id": canvass_result_id, "sequence": sequence}
+                    for sequence, canvass_result_id in enumerate(ids, start=first)
+                ],
+            )
+        logger.info(f"Numbered canvass results. [table={name}, rows={len(ids)}]")
+
+
+def _partition_legacy_table(engine: sqlalchemy.engine.base.Engine) -> None:
+    legacy = CanvassResult.__table__
+    add_missing_columns(engine, [legacy])
+    day = sqlalchemy.func.date(legacy.c.created_at)
+    days = [
+        datetime.date.fromisoformat(str(value)[:10])
+        for (value,) in query(sqlalchemy.select(day).distinct())
+    ]
+    columns = [column.name for column in legacy.columns]
+    with _schema_transaction() as connection:
+        for day_ in days:
+            table = partition_table(partition_name(day_))
+            table.create(connection, checkfirst=True)
+            connection.execute(
+                table.insert().from_select(
+                    columns,
+                    sqlalchemy.select(*(legacy.c[column] for column in columns)).where(
+                        day == day_.isoformat()
+                    ),
+                )
+            )
+        connection.exec_driver_sql(f"drop table {VIEW_NAME}")
+        _rebuild_view(connection)
+    logger.info(f"Partitioned canvass results by day. [partitions={len(days)}]")
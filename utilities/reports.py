@@ -0,0 +1,872 @@
+"""Generating batch analysis reports from canvass results.
+
+Each BatchAnalysis records a watermark (the latest memo ingest_sequence it covers,
+and how many memos that was). Later reports only summarize memos past the watermark
+and merge them into the previous topics, instead of re-reading every memo. The
+sequence follows commit order, so memos still buffered in another worker or synced
+with old timestamps land past the watermark rather than behind it. A full rebuild
+runs on demand, when REPORT_FULL_REBUILD_HOURS have passed since the last one, or
+when memos at or before the watermark were removed since the last report.
+
+Reports are generated by background report jobs, tracked in the reportjob table so
+that any worker can report on them. At most one job runs at a time across workers;
+starting a job while one is running attaches to it. Jobs stream the report text as
+GPT produces it, see stream_report_job().
+
+Reports over the token budget (REPORT_TOKEN_BUDGET, REPORT_COST_BUDGET_USD) send GPT
+a stratified sample of the memos, see utilities.llm.budget, and record how many memos
+and tokens were sent.
+
+With REPORT_PRECLUSTER=1 memos are first clustered locally (see
+utilities.llm.clustering), and GPT only sees a few representative memos per cluster
+with the cluster size. The cluster model is itself incremental, so each report is
+built from the whole corpus.
+
+generate_report(days=N) reports on only the memos created in the last N days, reading
+only the partitions that can hold them (see utilities.orm.partitions). These reports
+are always built from scratch and are kept apart from the latest report.
+
+get_cached_report() serves the latest report without waiting on GPT: when memos have
+changed since the report was made it returns the stale report and starts a report job.
+
+generate_region_report() reports on the memos in a geohash cell or bounding box. The
+region is split into cells that are summarized concurrently, and each cell's topics
+are kept in the regionsummary table until memos in that cell change.
+"""
+
+import datetime
+import functools
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from utilities.geo import (
+    BoundingBox,
+    cell_bounds,
+    cell_range,
+    cover_bounding_box,
+)
+from utilities.llm.budget import (
+    STRATUM_CELL_PRECISION,
+    StratifiedSampler,
+    estimate_tokens,
+    stratum,
+    token_budget,
+)
+from utilities.llm.dedupe import collapse_near_duplicates, format_collapsed_memos
+from utilities.llm.methods import (
+    SCRIPT_RECOMMENDATIONS_HEADING,
+    SUMMARIES_SYSTEM_MESSAGE,
+    ProgressCallback,
+    assemble_reduce_prompt,
+    format_report,
+    query_script_recommendations,
+    query_topics,
+    summarize_memos,
+)
+from utilities.orm.methods import (
+    fetch_latest_batch_analysis,
+    get_engine,
+    get_session,
+    load_rows_to_database,
+    query,
+)
+from utilities.orm.models import BatchAnalysis, CanvassResult, RegionSummary, ReportJob
+from utilities.orm.partitions import canvass_results
+
+logger = logging.getLogger(__name__)
+
+
+def generate_report(
+    full: bool = False,
+    on_progress: Optional[ProgressCallback] = None,
+    days: Optional[int] = None,
+) -> BatchAnalysis:
+    """Generate a new batch analysis, incrementally when possible.
+
+    Returns the previous analysis unchanged if no memos arrived since it was made.
+    on_progress receives the report text as GPT streams it, see ProgressCallback.
+
+    With days, reports on only the memos created in the last that many days instead,
+    always from scratch.
+    """
+    if days is not None:
+        return _generate_recent_report(days, on_progress)
+
+    previous = fetch_latest_batch_analysis()
+    if os.environ.get("REPORT_PRECLUSTER", "0") == "1":
+        return _generate_clustered_report(previous, full, on_progress)
+    if not full and _needs_full_rebuild(previous):
+        full = True
+
+    if full:
+        return _generate_full_report(on_progress)
+
+    new_memos = CanvassResult.ingest_sequence > previous.memo_sequence
+    new_memo_count = query(
+        sqlalchemy.select(sqlalchemy.func.count()).where(new_memos)
+    )[0][0]
+    if not new_memo_count:
+        logger.info("No new memos since last report, skipping generation.")
+        return previous
+
+    memos = _MemoTally(new_memos)
+    gpt_prompt, topics = summarize_memos(
+        _prompt_memos(memos),
+        previous_topics=previous.gpt_topics,
+        previous_memo_count=previous.memo_count,
+        on_progress=on_progress,
+    )
+    batch_analysis = _save_report(
+        gpt_prompt,
+        topics,
+        # Synced memos can be older than the ones the previous report covered
+        memo_watermark=max(
+            filter(None, (memos.watermark, previous.memo_watermark)), default=None
+        ),
+        memo_sequence=memos.sequence,
+        memo_count=previous.memo_count + memos.count,
+        full_rebuild_at=previous.full_rebuild_at,
+        sampled_memo_count=memos.sampled_count,
+        sampled_token_count=memos.sampled_tokens,
+        on_progress=on_progress,
+    )
+    logger.info(
+        f"Generated incremental report. [new_memos={memos.count}, sampled={memos.sampled_count}]"
+    )
+    return batch_analysis
+
+
+def _generate_full_report(
+    on_progress: Optional[ProgressCallback] = None,
+) -> BatchAnalysis:
+    memos = _MemoTally()
+    gpt_prompt, topics = summarize_memos(_prompt_memos(memos), on_progress=on_progress)
+    batch_analysis = _save_report(
+        gpt_prompt,
+        topics,
+        memo_watermark=memos.watermark,
+        memo_sequence=memos.sequence,
+        memo_count=memos.count,
+        full_rebuild_at=datetime.datetime.now(),
+        sampled_memo_count=memos.sampled_count,
+        sampled_token_count=memos.sampled_tokens,
+        on_progress=on_progress,
+    )
+    logger.info(
+        f"Generated full report. [memos={memos.count}, sampled={memos.sampled_count}]"
+    )
+    return batch_analysis
+
+
+def _generate_recent_report(
+    days: int, on_progress: Optional[ProgressCallback] = None
+) -> BatchAnalysis:
+    now = datetime.datetime.now()
+    since = now - datetime.timedelta(days=days)
+    source = canvass_results(since=since)
+    memos = _MemoTally(source.created_at >= since, source=source)
+    gpt_prompt, topics = summarize_memos(_prompt_memos(memos), on_progress=on_progress)
+    batch_analysis = _save_report(
+        gpt_prompt,
+        topics,
+        memo_watermark=memos.watermark,
+        memo_sequence=memos.sequence,
+        memo_count=memos.count,
+        full_rebuild_at=now,
+        sampled_memo_count=memos.sampled_count,
+        sampled_token_count=memos.sampled_tokens,
+        on_progress=on_progress,
+        days=days,
+    )
+    logger.info(
+        f"Generated report on recent memos. [days={days}, memos={memos.count}, sampled={memos.sampled_count}]"
+    )
+    return batch_analysis
+
+
+def _generate_clustered_report(
+    previous: Optional[BatchAnalysis],
+    full: bool,
+    on_progress: Optional[ProgressCallback] = None,
+) -> BatchAnalysis:
+    # Deferred, so numpy is only imported when pre-clustering is enabled
+    from utilities.llm.clustering import format_cluster_memos, refresh_topic_model
+
+    model = refresh_topic_model()
+    if (
+        not full
+        and previous is not None
+        and previous.memo_count == model.document_count
+        and previous.memo_sequence == model.memo_sequence
+    ):
+        logger.info("No new memos since last report, skipping generation.")
+        return previous
+
+    model_topics = model.topics()
+    clusters = format_cluster_memos(model_topics)
+    gpt_prompt, topics = summarize_memos(clusters, on_progress=on_progress)
+    batch_analysis = _save_report(
+        gpt_prompt,
+        topics,
+        memo_watermark=model.memo_watermark,
+        memo_sequence=model.memo_sequence,
+        memo_count=model.document_count,
+        full_rebuild_at=datetime.datetime.now(),
+        sampled_memo_count=sum(len(topic["representatives"]) for topic in model_topics),
+        sampled_token_count=sum(estimate_tokens(cluster) for cluster in clusters),
+        on_progress=on_progress,
+    )
+    logger.info(
+        f"Generated report from topic clusters. [memos={model.document_count}, clusters={len(clusters)}]"
+    )
+    return batch_analysis
+
+
+def _memo_tokens(source=CanvassResult) -> sqlalchemy.ColumnElement:
+    # Rows ingested before token counts were stored get the same estimate in SQL
+    return sqlalchemy.func.coalesce(
+        source.token_count, sqlalchemy.func.length(source.memo) // 4 + 1
+    )
+
+
+class _MemoTally:
+    """Reads (memo, simhash) pairs of the memos matching conditions in commit order,
+    counting the memos and tracking the latest created_at and ingest_sequence as
+    they go past.
+
+    Memos are read in pages of DB_STREAM_BATCH_SIZE (default 1000) ingest sequence
+    numbers, each its own short query, so no read transaction stays open while the
+    caller sends memos to GPT; a long-lived snapshot would keep SQLite from
+    checkpointing its WAL. Memos committed after the tally was created are left out.
+
+    When the memos are over the token budget only a stratified sample of them is
+    yielded, see utilities.llm.budget. count and watermark still cover every memo.
+
+    source is CanvassResult or an alias of it from canvass_results(), which the
+    conditions are then on.
+    """
+
+    def __init__(self, *conditions, source=CanvassResult) -> None:
+        first, last = query(
+            sqlalchemy.select(
+                sqlalchemy.func.min(source.ingest_sequence),
+                sqlalchemy.func.max(source.ingest_sequence),
+            ).where(*conditions)
+        )[0]
+        # Sequence numbers start at 1, so (0, 0] reads nothing
+        self._first, self._last = (first - 1, last) if first is not None else (0, 0)
+        self._source = source
+        self._conditions = (
+            *conditions,
+            source.ingest_sequence > self._first,
+            source.ingest_sequence <= self._last,
+        )
+        self._sampler = _budget_sampler(self._conditions, source)
+        self._page_size = int(os.environ.get("DB_STREAM_BATCH_SIZE", 1000))
+        self.count = 0
+        self.watermark: Optional[datetime.datetime] = None
+        self.sequence: Optional[int] = None
+        self.sampled_count = 0
+        self.sampled_tokens = 0
+
+    def __iter__(self) -> Iterator[tuple[str, Optional[int]]]:
+        source = self._source
+        for start in range(self._first, self._last, self._page_size):
+            rows = query(
+                sqlalchemy.select(
+                    source.memo,
+                    source.simhash,
+                    source.created_at,
+                    source.geohash,
+                    source.ingest_sequence,
+                    _memo_tokens(source),
+                )
+                .where(
+                    *self._conditions,
+                    source.ingest_sequence > start,
+                    source.ingest_sequence <= start + self._page_size,
+                )
+                .order_by(source.ingest_sequence)
+            )
+            for memo, fingerprint, created_at, geohash, sequence, tokens in rows:
+                self.count += 1
+                self.sequence = sequence
+                if self.watermark is None or created_at > self.watermark:
+                    self.watermark = created_at
+                if self._sampler is not None and not self._sampler.keep(
+                    stratum(created_at, geohash), tokens
+                ):
+                    continue
+                self.sampled_count += 1
+                self.sampled_tokens += tokens
+                yield memo, fingerprint
+
+
+def _budget_sampler(
+    conditions: tuple, source=CanvassResult
+) -> Optional[StratifiedSampler]:
+    """Sampler for the memos matching conditions, or None if they fit the budget."""
+    budget = token_budget()
+    if budget is None:
+        return None
+
+    day = sqlalchemy.func.date(source.created_at)
+    cell = sqlalchemy.func.substr(source.geohash, 1, STRATUM_CELL_PRECISION)
+    rows = query(
+        sqlalchemy.select(
+            day, cell, sqlalchemy.func.count(), sqlalchemy.func.sum(_memo_tokens(source))
+        )
+        .where(*conditions)
+        .group_by(day, cell)
+    )
+    # Dates come back as strings from SQLite and as dates elsewhere
+    strata = {(str(day)[:10], cell): (memos, tokens) for day, cell, memos, tokens in rows}
+    total = sum(tokens for _, tokens in strata.values())
+    if total <= budget:
+        return None
+    logger.info(
+        f"Memos over token budget, sampling. [tokens={total}, budget={budget}, strata={len(strata)}]"
+    )
+    return StratifiedSampler(strata, budget)
+
+
+def _prompt_memos(memos: _MemoTally) -> Iterable[str]:
+    """Memo text to summarize, with near-duplicates collapsed unless REPORT_DEDUPE=0."""
+    if os.environ.get("REPORT_DEDUPE", "1") == "0":
+        return (memo for memo, _ in memos)
+
+    collapsed = collapse_near_duplicates(memos)
+    logger.info(
+        f"Collapsed near-duplicate memos. [memos={memos.sampled_count}, unique={len(collapsed)}]"
+    )
+    return format_collapsed_memos(collapsed)
+
+
+def _needs_full_rebuild(previous: Optional[BatchAnalysis]) -> bool:
+    if previous is None or previous.gpt_topics is None:
+        return True
+    if previous.memo_sequence is None or previous.full_rebuild_at is None:
+        return True
+
+    rebuild_hours = float(os.environ.get("REPORT_FULL_REBUILD_HOURS", 24))
+    age = datetime.datetime.now() - previous.full_rebuild_at
+    if age > datetime.timedelta(hours=rebuild_hours):
+        logger.info("Scheduled full report rebuild.")
+        return True
+
+    # Memos purged or expired since would still be counted incrementally
+    covered = query(
+        sqlalchemy.select(sqlalchemy.func.count()).where(
+            CanvassResult.ingest_sequence <= previous.memo_sequence
+        )
+    )[0][0]
+    if covered != previous.memo_count:
+        logger.info(
+            f"Memos changed behind the report watermark, rebuilding. [expected={previous.memo_count}, found={covered}]"
+        )
+        return True
+
+    return False
+
+
+def _save_report(
+    gpt_prompt: str,
+    topics: str,
+    memo_watermark: Optional[datetime.datetime],
+    memo_sequence: Optional[int],
+    memo_count: int,
+    full_rebuild_at: datetime.datetime,
+    sampled_memo_count: int,
+    sampled_token_count: int,
+    on_progress: Optional[ProgressCallback] = None,
+    days: Optional[int] = None,
+) -> BatchAnalysis:
+    on_token = None
+    if on_progress is not None:
+        on_progress("recommendations", SCRIPT_RECOMMENDATIONS_HEADING)
+        on_token = functools.partial(on_progress, "recommendations")
+    gpt_output = format_report(
+        topics, query_script_recommendations(topics, on_token=on_token)
+    )
+    batch_analysis = BatchAnalysis(
+        batch_analysis_id=str(uuid.uuid4()),
+        gpt_input_prompt=gpt_prompt,
+        gpt_output=gpt_output,
+        gpt_topics=topics,
+        memo_watermark=memo_watermark,
+        memo_sequence=memo_sequence,
+        memo_count=memo_count,
+        full_rebuild_at=full_rebuild_at,
+        sampled_memo_count=sampled_memo_count,
+        sampled_token_count=sampled_token_count,
+        days=days,
+        created_at=datetime.datetime.now(),
+    )
+    load_rows_to_database(batch_analysis)
+    return batch_analysis
+
+
+def memo_fingerprint() -> tuple[int, Optional[int]]:
+    """Count and latest ingest_sequence of all memos.
+
+    Matches (memo_count, memo_sequence) of a batch analysis that is up to date.
+    """
+    count, sequence = query(
+        sqlalchemy.select(
+            sqlalchemy.func.count(), sqlalchemy.func.max(CanvassResult.ingest_sequence)
+        )
+    )[0]
+    return count, sequence
+
+
+class ReportCache:
+    """Stale-while-revalidate cache of the latest report text.
+
+    Within ttl_seconds of the last check the cached report is returned without
+    touching the database. After that the memo fingerprint is compared with the
+    one the report covers; if it differs the cached report is still returned and
+    a background report job is started, unless one is already running in any worker.
+    """
+
+    def __init__(self, ttl_seconds: float) -> None:
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._report: Optional[str] = None
+        self._fingerprint: Optional[tuple] = None
+        self._checked_at = 0.0
+        self._refresh_job_id: Optional[str] = None
+
+    def get(self) -> tuple[str, Optional[str]]:
+        """The cached report, and the id of the report job refreshing it if stale."""
+        with self._lock:
+            if (
+                self._report is not None
+                and time.monotonic() - self._checked_at < self.ttl_seconds
+            ):
+                return self._report, self._refresh_job_id
+
+        fingerprint = memo_fingerprint()
+        if fingerprint != self._fingerprint:
+            # Another worker may already have regenerated the report
+            self._load_latest()
+
+        if self._report is None:
+            # Nothing to serve yet, wait for (or join) the first generation
+            if not wait_for_report_job(start_report_job()):
+                raise RuntimeError("Report generation failed.")
+            self._load_latest()
+            return self._report, None
+
+        with self._lock:
+            report, stale = self._report, self._fingerprint != fingerprint
+        refresh_job_id = start_report_job() if stale else None
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._refresh_job_id = refresh_job_id
+        return report, refresh_job_id
+
+    def _load_latest(self) -> None:
+        batch_analysis = fetch_latest_batch_analysis()
+        if batch_analysis is None:
+            return
+        with self._lock:
+            self._report = batch_analysis.gpt_output
+            self._fingerprint = (batch_analysis.memo_count, batch_analysis.memo_sequence)
+            self._checked_at = time.monotonic()
+
+
+_report_cache: Optional[ReportCache] = None
+_report_cache_lock = threading.Lock()
+
+
+def get_cached_report() -> tuple[str, Optional[str]]:
+    """Latest report text, regenerated in the background when memos change.
+
+    Also returns the id of the report job regenerating it, or None if the report is
+    up to date, so callers can follow the refresh with stream_report_job().
+
+    REPORT_CACHE_TTL_SECONDS (default 30) sets how long a report is served before
+    the memo fingerprint is checked again.
+    """
+    global _report_cache
+
+    if _report_cache is None:
+        with _report_cache_lock:
+            if _report_cache is None:
+                _report_cache = ReportCache(
+                    ttl_seconds=float(os.environ.get("REPORT_CACHE_TTL_SECONDS", 30))
+                )
+    return _report_cache.get()
+
+
+ACTIVE_REPORT_JOB_STATUSES = ("pending", "running")
+
+
+class _LocalReportJob:
+    """Progress of a report job running in this process, for low-latency streaming."""
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.stage: Optional[str] = None
+        self.output = ""
+        self.finished = False
+
+
+_local_report_jobs: dict[str, _LocalReportJob] = {}
+_local_report_jobs_lock = threading.Lock()
+
+
+def start_report_job(full: bool = False) -> str:
+    """Start a background report job, or attach to the one already running.
+
+    A job counts as running until it finishes or stops updating for
+    REPORT_JOB_STALE_SECONDS (default 300), e.g. because its worker died.
+
+    Returns the report_job_id.
+    """
+    now = datetime.datetime.now()
+    report_job_id = str(uuid.uuid4())
+    active_job = _active_report_jobs(now)
+
+    # Check and insert in one statement, so two workers cannot both start a job
+    columns = {
+        "report_job_id": report_job_id,
+        "status": "pending",
+        "stage": None,
+        "full_rebuild": full,
+        "output": "",
+        "error": None,
+        "batch_analysis_id": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    table = ReportJob.__table__
+    while True:
+        query(
+            table.insert().from_select(
+                list(columns),
+                sqlalchemy.select(
+                    *[
+                        sqlalchemy.literal(value, type_=table.c[name].type)
+                        for name, value in columns.items()
+                    ]
+                ).where(~active_job.exists()),
+            ),
+            commit=True,
+        )
+        rows = query(active_job.order_by(ReportJob.created_at).limit(1))
+        if rows:
+            break
+        # The running job finished between the insert and this read, start again
+
+    active_job_id = rows[0][0]
+    if active_job_id != report_job_id:
+        logger.info(f"Attached to running report job. [report_job_id={active_job_id}]")
+        return active_job_id
+
+    local_job = _LocalReportJob()
+    with _local_report_jobs_lock:
+        _local_report_jobs[report_job_id] = local_job
+    threading.Thread(
+        target=_run_report_job,
+        args=(report_job_id, full, local_job),
+        name=f"report-job-{report_job_id}",
+        daemon=True,
+    ).start()
+    logger.info(f"Started report job. [report_job_id={report_job_id}, full={full}]")
+    return report_job_id
+
+
+def report_job_status(report_job_id: str) -> Optional[dict]:
+    """Current state of a report job, or None if there is no such job."""
+    with get_session() as session:
+        report_job = session.get(ReportJob, report_job_id)
+    if report_job is None:
+        return None
+
+    status = {
+        "report_job_id": report_job.report_job_id,
+        "status": report_job.status,
+        "stage": report_job.stage,
+        "output": report_job.output,
+        "error": report_job.error,
+        "batch_analysis_id": report_job.batch_analysis_id,
+    }
+    local_job = _local_report_jobs.get(report_job_id)
+    if local_job is not None:
+        # Fresher than the throttled copy in the database
+        with local_job.condition:
+            status["stage"], status["output"] = local_job.stage, local_job.output
+    elif report_job.status in ACTIVE_REPORT_JOB_STATUSES and (
+        datetime.datetime.now() - report_job.updated_at
+        > datetime.timedelta(seconds=_report_job_stale_seconds())
+    ):
+        status["status"] = "failed"
+        status["error"] = "Report job stopped responding."
+    return status
+
+
+def stream_report_job(
+    report_job_id: str, keepalive_seconds: float = 15
+) -> Iterator[tuple[str, str]]:
+    """Follow a report job, yielding (event, data) pairs until it finishes.
+
+    Events are "stage" when the job moves to another stage, "output" with each new
+    piece of report text, "ping" when nothing happened for keepalive_seconds, and
+    finally "done" with the complete report or "error" with a message.
+
+    Jobs running in this process are followed as GPT streams tokens; jobs running in
+    another worker are followed by polling the reportjob table.
+    """
+    stage = None
+    sent = 0
+    last_event_at = time.monotonic()
+    while True:
+        local_job = _local_report_jobs.get(report_job_id)
+        if local_job is not None:
+            with local_job.condition:
+                local_job.condition.wait_for(
+                    lambda: local_job.finished
+                    or local_job.stage != stage
+                    or len(local_job.output) > sent,
+                    timeout=keepalive_seconds,
+                )
+                new_stage, output = local_job.stage, local_job.output
+                finished = local_job.finished
+            status = report_job_status(report_job_id) if finished else None
+        else:
+            status = report_job_status(report_job_id)
+            if status is None:
+                yield "error", "No such report job."
+                return
+            new_stage, output = status["stage"], status["output"]
+            finished = status["status"] not in ACTIVE_REPORT_JOB_STATUSES
+
+        changed = False
+        if new_stage != stage:
+            stage = new_stage
+            changed = True
+            yield "stage", stage or ""
+        if len(output) > sent:
+            changed = True
+            yield "output", output[sent:]
+            sent = len(output)
+
+        if finished:
+            if status["status"] == "succeeded":
+                yield "done", status["output"]
+            else:
+                yield "error", status["error"] or "Report generation failed."
+            return
+
+        if changed:
+            last_event_at = time.monotonic()
+        elif time.monotonic() - last_event_at >= keepalive_seconds:
+            last_event_at = time.monotonic()
+            yield "ping", ""
+        if local_job is None and not changed:
+            time.sleep(_REPORT_JOB_POLL_SECONDS)
+
+
+def wait_for_report_job(report_job_id: str) -> bool:
+    """Block until a report job finishes. Returns whether it succeeded."""
+    for event, _ in stream_report_job(report_job_id):
+        if event in ("done", "error"):
+            return event == "done"
+    return False
+
+
+# How often jobs in other workers are polled, and job progress is written out
+_REPORT_JOB_POLL_SECONDS = 0.5
+
+
+def _report_job_stale_seconds() -> float:
+    return float(os.environ.get("REPORT_JOB_STALE_SECONDS", 300))
+
+
+def _active_report_jobs(now: datetime.datetime) -> sqlalchemy.Select:
+    stale_before = now - datetime.timedelta(seconds=_report_job_stale_seconds())
+    return sqlalchemy.select(ReportJob.report_job_id).where(
+        ReportJob.status.in_(ACTIVE_REPORT_JOB_STATUSES),
+        ReportJob.updated_at > stale_before,
+    )
+
+
+def _update_report_job(report_job_id: str, **values) -> None:
+    query(
+        sqlalchemy.update(ReportJob)
+        .where(ReportJob.report_job_id == report_job_id)
+        .values(updated_at=datetime.datetime.now(), **values),
+        commit=True,
+    )
+
+
+def _run_report_job(
+    report_job_id: str, full: bool, local_job: _LocalReportJob
+) -> None:
+    last_written = time.monotonic()
+
+    def on_progress(stage: str, text: str) -> None:
+        nonlocal last_written
+
+        with local_job.condition:
+            stage_changed = stage != local_job.stage
+            local_job.stage = stage
+            local_job.output += text
+            local_job.condition.notify_all()
+            output = local_job.output
+        # Throttle writes so streaming tokens does not hog the database write lock
+        now = time.monotonic()
+        if stage_changed or now - last_written >= _REPORT_JOB_POLL_SECONDS:
+            last_written = now
+            _update_report_job(report_job_id, stage=stage, output=output)
+
+    try:
+        _update_report_job(report_job_id, status="running")
+        batch_analysis = generate_report(full=full, on_progress=on_progress)
+        output = batch_analysis.gpt_output
+        _update_report_job(
+            report_job_id,
+            status="succeeded",
+            stage=None,
+            output=output,
+            batch_analysis_id=batch_analysis.batch_analysis_id,
+        )
+        logger.info(f"Report job succeeded. [report_job_id={report_job_id}]")
+    except Exception as error:
+        logger.exception(f"Report job failed. [report_job_id={report_job_id}]")
+        output = local_job.output
+        _update_report_job(report_job_id, status="failed", error=str(error))
+    finally:
+        with local_job.condition:
+            local_job.output = output
+            local_job.finished = True
+            local_job.condition.notify_all()
+        with _local_report_jobs_lock:
+            del _local_report_jobs[report_job_id]
+
+
+def generate_region_report(
+    cell: Optional[str] = None, box: Optional[BoundingBox] = None
+) -> dict:
+    """Report on the memos in a geohash cell or a bounding box.
+
+    A bounding box is covered with at most REGION_MAX_CELLS (default 16) cells, each
+    clipped to the box. Cells are summarized concurrently, reusing a cell's stored
+    topics while its memos are unchanged, and the cell topics are then merged. The
+    cells share REPORT_MAX_WORKERS GPT calls at a time, like one report's map stage.
+
+    Returns the report with the cells and memo count it covers.
+    """
+    if (cell is None) == (box is None):
+        raise ValueError("Pass either a cell or a bounding box.")
+    if cell is not None:
+        regions = [(cell, None)]
+    else:
+        max_cells = int(os.environ.get("REGION_MAX_CELLS", 16))
+        regions = []
+        for covering_cell in cover_bounding_box(box, max_cells):
+            bounds = cell_bounds(covering_cell)
+            clip = None if box.contains(bounds) else box.intersection(bounds)
+            regions.append((covering_cell, clip))
+
+    max_workers = int(os.environ.get("REPORT_MAX_WORKERS", 4))
+    # Each cell's summary has its own map stage, so its GPT calls are bounded here
+    call_slots = threading.BoundedSemaphore(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summaries = list(
+            executor.map(lambda region: _region_topics(*region, call_slots), regions)
+        )
+    summaries = [summary for summary in summaries if summary is not None]
+    memo_count = sum(count for count, _ in summaries)
+
+    if not summaries:
+        report = None
+    else:
+        if len(summaries) == 1:
+            topics = summaries[0][1]
+        else:
+            topics = query_topics(
+                assemble_reduce_prompt(
+                    [topics for _, topics in summaries], final=True
+                ),
+                SUMMARIES_SYSTEM_MESSAGE,
+            )
+        report = format_report(topics, query_script_recommendations(topics))
+    logger.info(
+        f"Generated region report. [cells={len(regions)}, memos={memo_count}]"
+    )
+    return {
+        "cells": [region_cell for region_cell, _ in regions],
+        "memo_count": memo_count,
+        "report": report,
+    }
+
+
+def _region_conditions(cell: str, clip: Optional[BoundingBox]) -> list:
+    lower, upper = cell_range(cell)
+    conditions = [CanvassResult.geohash >= lower, CanvassResult.geohash < upper]
+    if clip is not None:
+        # Refines the rows of the geohash range scan. The cast keeps the comparison
+        # numeric on tables created when coordinates were stored as text.
+        geo_lat = sqlalchemy.cast(CanvassResult.geo_lat, sqlalchemy.Float)
+        geo_long = sqlalchemy.cast(CanvassResult.geo_long, sqlalchemy.Float)
+        conditions += [
+            geo_lat.between(clip.south, clip.north),
+            geo_long.between(clip.west, clip.east),
+        ]
+    return conditions
+
+
+def _region_topics(
+    cell: str, clip: Optional[BoundingBox], call_slots: threading.Semaphore
+) -> Optional[tuple[int, str]]:
+    """Memo count and topics of one cell, or None if it has no memos."""
+    region = cell if clip is None else f"{cell}:{','.join(map(str, clip))}"
+    conditions = _region_conditions(cell, clip)
+    count, watermark = query(
+        sqlalchemy.select(
+            sqlalchemy.func.count(), sqlalchemy.func.max(CanvassResult.created_at)
+        ).where(*conditions)
+    )[0]
+    if not count:
+        return None
+
+    with get_session() as session:
+        summary = session.get(RegionSummary, region)
+    if (
+        summary is not None
+        and summary.memo_count == count
+        and summary.memo_watermark == watermark
+    ):
+        return count, summary.gpt_topics
+
+    memos = _MemoTally(*conditions)
+    _, topics = summarize_memos(_prompt_memos(memos), call_slots=call_slots)
+    # An upsert, since another request may be summarizing the same cell
+    values = {
+        "region": region,
+        "gpt_topics": topics,
+        "memo_count": memos.count,
+        "memo_watermark": memos.watermark,
+        "created_at": datetime.datetime.now(),
+    }
+    dialect = sqlite if get_engine().dialect.name == "sqlite" else postgresql
+    statement = dialect.insert(RegionSummary).values(**values)
+    query(
+        statement.on_conflict_do_update(
+            index_elements=[RegionSummary.region],
+            set_={name: statement.excluded[name] for name in values if name != "region"},
+        ),
+        commit=True,
+    )
+    logger.info(f"Summarized region. [region={region}, memos={memos.count}]")
+    return memos.count, topics